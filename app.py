@@ -3,7 +3,7 @@ from flask_wtf import CSRFProtect
 from flask_bootstrap import Bootstrap5
 from flask_login import LoginManager
 
-import database, auth, config
+import database, auth, config, importer, migrations, compression, assets, render, snapshot, backup
 
 def create_app(test_config=None, testing=False):
     app = Flask(__name__)
@@ -23,7 +23,14 @@ def create_app(test_config=None, testing=False):
     csrf = CSRFProtect(app)
     bootstrap = Bootstrap5(app)
     login_manager.init_app(app)
+    auth.init(app)
     database.init(app)
+    importer.init(app)
+    migrations.init(app)
+    snapshot.init(app)
+    backup.init(app)
+    compression.init(app)
+    assets.init(app)
     
     @app.context_processor
     def inject_user_roles():
@@ -31,7 +38,9 @@ def create_app(test_config=None, testing=False):
     
     @login_manager.user_loader
     def load_user(user_id):
-        return database.User.get_one(id=int(user_id), or_none=True)
+        return database.user_cache.get(int(user_id))
+
+    render.init(app)
         
     return app
 
@@ -0,0 +1,137 @@
+"""
+ASGI entry point, e.g. ``uvicorn asgi:app``.
+
+The Flask views run on threads. Reads, the search, table data and exports, run on a larger pool than writes
+and the response is sent to the client from the event loop, so a slow client doesn't hold a thread while it
+downloads a large page. All other requests, including every write, are handled as by the WSGI server.
+"""
+import sys, io, asyncio, contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from app import create_app
+
+__all__ = ['ASGIApp', 'app']
+
+class ASGIApp:
+    """
+    Serve a WSGI app over ASGI.
+
+    GET and HEAD requests for one of ``read_paths`` run on a pool of ``read_workers`` threads, all other
+    requests on a pool of ``write_workers`` threads. A read path matches only that path, unless it ends with
+    ``*``, then it matches every path starting with the rest.
+    """
+    def __init__(self, wsgi_app, read_paths=(), read_workers=8, write_workers=2):
+        self.wsgi_app = wsgi_app
+        self.read_paths = frozenset(path for path in read_paths if not path.endswith('*'))
+        self.read_prefixes = tuple(path.removesuffix('*') for path in read_paths if path.endswith('*'))
+        self.read_pool = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix='asgi-read')
+        self.write_pool = ThreadPoolExecutor(max_workers=write_workers, thread_name_prefix='asgi-write')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        else:
+            raise ValueError(f'Unsupported scope type "{scope["type"]}"')
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.read_pool.shutdown(wait=False)
+                self.write_pool.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def is_read(self, scope):
+        return scope['method'] in ('GET', 'HEAD') and (scope['path'] in self.read_paths or
+                                                       scope['path'].startswith(self.read_prefixes))
+
+    async def http(self, scope, receive, send):
+        body = io.BytesIO()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.write(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+        body.seek(0)
+
+        pool = self.read_pool if self.is_read(scope) else self.write_pool
+        loop = asyncio.get_running_loop()
+
+        # Every call for the request is made in the same context so that the request context of a streamed
+        # response is still there when the next chunk is made on another thread
+        context = contextvars.copy_context()
+        def run(func, *args):
+            return loop.run_in_executor(pool, context.run, func, *args)
+
+        response = {}
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+            return response.setdefault('written', []).append
+
+        def first_chunk():
+            chunks = self.wsgi_app(environ(scope, body), start_response)
+            iterator = iter(chunks)
+            # start_response may not be called until the first chunk is made
+            return chunks, iterator, b''.join(response.get('written', [])) + next(iterator, b'')
+
+        chunks, iterator, chunk = await run(first_chunk)
+        try:
+            await send({'type': 'http.response.start', 'status': response['status'],
+                        'headers': response['headers']})
+            while chunk is not None:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await run(next, iterator, None)
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if hasattr(chunks, 'close'):
+                await run(chunks.close)
+
+def environ(scope, body):
+    """
+    Return the WSGI environ for the ASGI ``scope`` of a request with ``body``.
+    """
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {'REQUEST_METHOD': scope['method'],
+               'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+               'PATH_INFO': scope['path'].encode().decode('latin-1'),
+               'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+               'SERVER_NAME': server[0],
+               'SERVER_PORT': str(server[1]),
+               'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+               'REMOTE_ADDR': client[0],
+               'REMOTE_PORT': str(client[1]),
+               'wsgi.version': (1, 0),
+               'wsgi.url_scheme': scope.get('scheme', 'http'),
+               'wsgi.input': body,
+               'wsgi.errors': sys.stderr,
+               'wsgi.multithread': True,
+               'wsgi.multiprocess': True,
+               'wsgi.run_once': False,
+               'wsgi.input_terminated': True,  # The whole body has been read
+               'CONTENT_LENGTH': str(body.getbuffer().nbytes)}
+
+    for name, value in scope.get('headers', []):
+        name, value = name.decode('latin-1').upper().replace('-', '_'), value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        elif name != 'CONTENT_TYPE':
+            name = f'HTTP_{name}'
+        environ[name] = f'{environ[name]},{value}' if name in environ else value
+
+    return environ
+
+flask_app = create_app()
+app = ASGIApp(flask_app,
+              read_paths=flask_app.config['ASGI_READ_PATHS'],
+              read_workers=flask_app.config['ASGI_READ_WORKERS'],
+              write_workers=flask_app.config['ASGI_WRITE_WORKERS'])
@@ -0,0 +1,146 @@
+import os, json, hashlib, urllib.request
+import click
+import flask
+
+__all__ = ['VENDOR', 'asset_url', 'build_manifest', 'vendor']
+
+# Third party files that are served from the static folder and committed with their licenses, so that a
+# deployment doesn't need to download anything. Path in the static folder: where to download it from. To upgrade
+# change the version, run 'flask assets vendor' and commit the files. A file that is missing from the static
+# folder is used from the download location.
+GRIDJS_VERSION = '6.2.0'  # MIT
+VENDOR = {'vendor/gridjs/gridjs.umd.js': f'https://unpkg.com/gridjs@{GRIDJS_VERSION}/dist/gridjs.umd.js',
+          'vendor/gridjs/mermaid.min.css': f'https://unpkg.com/gridjs@{GRIDJS_VERSION}/dist/theme/mermaid.min.css'}
+
+# Files in the static folder that are not assets
+IGNORE = ('.gz', '.br', 'manifest.json')
+
+# Fingerprinted files never change so they can be cached forever
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+_app = None
+_manifest = {}  # filename: fingerprinted filename
+_filenames = {}  # fingerprinted filename: filename
+_fingerprints = {}  # path: (modification time, size, fingerprinted filename)
+
+def init(app):
+    globals()['_app'] = app
+    load_manifest()
+
+    # Serve the fingerprinted filenames from the static route
+    static_view = app.view_functions['static']
+    def static(filename):
+        if _app.debug:
+            load_manifest()
+
+        if (source := _filenames.get(filename, None)) is None:
+            return static_view(filename=filename)
+
+        response = flask.make_response(static_view(filename=source))
+        if response.status_code in (200, 304):
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+        return response
+    app.view_functions['static'] = static
+
+    app.add_template_global(asset_url)
+
+    @app.cli.group('assets')
+    def assets_command():
+        """Manage the static assets."""
+
+    @assets_command.command('vendor')
+    def vendor_command():
+        """Download the third party files into the static folder, to upgrade them."""
+        for path in vendor(app.static_folder):
+            click.echo(f'Downloaded {path}')
+        click.echo("Run 'flask assets manifest' to fingerprint them and commit the files")
+
+    @assets_command.command('manifest')
+    def manifest_command():
+        """Write the fingerprinted filenames of the static files to manifest.json in the static folder."""
+        # The pages would load the missing files from the download location, which a mirror without internet
+        # access can't reach
+        missing = [filename for filename in VENDOR
+                   if not os.path.exists(os.path.join(app.static_folder, *filename.split('/')))]
+        if missing:
+            raise click.ClickException(f'The third party files {", ".join(missing)} are missing, '
+                                       f"download them with 'flask assets vendor'")
+
+        path = os.path.join(app.static_folder, 'manifest.json')
+        with open(path, 'w') as file:
+            json.dump(build_manifest(app.static_folder), file, indent=2, sort_keys=True)
+        click.echo(f'Wrote {path}')
+
+def _fingerprint(path, filename):
+    # Files are only hashed again when they have changed
+    stat = os.stat(path)
+    cached = _fingerprints.get(path, None)
+    if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+
+    hash = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 16), b''):
+            hash.update(chunk)
+    name, ext = os.path.splitext(filename)
+    fingerprinted = f'{name}.{hash.hexdigest()[:12]}{ext}'
+    _fingerprints[path] = (stat.st_mtime_ns, stat.st_size, fingerprinted)
+    return fingerprinted
+
+def build_manifest(folder):
+    """
+    Return a dict mapping the path, relative to ``folder``, of each file in ``folder`` to a path where the
+    file name includes a hash of its content.
+    """
+    manifest = {}
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            if name.endswith(IGNORE):
+                continue
+            path = os.path.join(root, name)
+            filename = os.path.relpath(path, folder).replace(os.sep, '/')
+            manifest[filename] = _fingerprint(path, filename)
+    return manifest
+
+def load_manifest():
+    # The manifest written by 'flask assets manifest' is used if there is one. In debug mode the static folder
+    # is always read, since the files change while the app runs.
+    path = os.path.join(_app.static_folder, 'manifest.json')
+    if not _app.debug and os.path.exists(path):
+        with open(path) as file:
+            manifest = json.load(file)
+    else:
+        manifest = build_manifest(_app.static_folder)
+    globals()['_filenames'] = {v: k for k, v in manifest.items()}
+    globals()['_manifest'] = manifest
+
+def asset_url(filename):
+    """
+    Like ``url_for('static', filename=filename)`` but returns the fingerprinted url of the file.
+    """
+    if (fingerprinted := _manifest.get(filename, None)) is not None:
+        return flask.url_for('static', filename=fingerprinted)
+    elif filename in VENDOR:
+        return VENDOR[filename]
+    else:
+        return flask.url_for('static', filename=filename)
+
+def vendor(folder):
+    """
+    Download the files in ``VENDOR`` into ``folder``. Returns the paths of the downloaded files.
+    """
+    paths = []
+    for filename, url in VENDOR.items():
+        path = os.path.join(folder, *filename.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with urllib.request.urlopen(url, timeout=30) as response:
+            data = response.read()
+        with open(path, 'wb') as file:
+            file.write(data)
+        paths.append(path)
+
+    if _app is not None:
+        load_manifest()
+    return paths
@@ -1,5 +1,7 @@
-from functools import wraps
+from functools import wraps, lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from flask_login import current_user
+from werkzeug.security import check_password_hash, generate_password_hash
 
 import render
 
@@ -15,7 +17,26 @@ ROLE = dict(deactivated = DEACTIVATED,
             admin = ADMIN)
 
 __all__ = ['DEACTIVATED', 'UNVERIFIED', 'VERIFIED', 'MODERATOR', 'ADMIN', 'ROLE',
-           'required', 'verified_required', 'moderator_required', 'admin_required']
+           'required', 'verified_required', 'moderator_required', 'admin_required',
+           'hash_password', 'check_password', 'needs_rehash']
+
+# Passwords are hashed on a small pool of threads so that a burst of logins in a threaded worker cannot use
+# more than that many cores and starve the other requests of the process. The request thread still waits for
+# the hash, so a login takes as long as before and holds its thread, and with sync workers, which handle one
+# request at a time, the pool changes nothing. The hash functions release the GIL so the pool threads run in
+# parallel. With PASSWORD_HASH_WORKERS = 0 passwords are hashed on the request thread.
+_hash_method = 'scrypt:32768:8:1'
+_hash_workers = 2
+_hash_pool = None
+
+def init(app):
+    globals()['_hash_method'] = app.config.get('PASSWORD_HASH_METHOD', _hash_method)
+    globals()['_hash_workers'] = app.config.get('PASSWORD_HASH_WORKERS', _hash_workers)
+    if _hash_pool is not None:
+        _hash_pool.shutdown()
+    globals()['_hash_pool'] = None
+    if _hash_workers > 0:
+        globals()['_hash_pool'] = ThreadPoolExecutor(max_workers=_hash_workers, thread_name_prefix='password-hash')
 
 def role_description(auth_level):
     for k, v in ROLE.items():
@@ -24,6 +45,37 @@ def role_description(auth_level):
     else:
         return auth_level
 
+#################
+### Passwords ###
+#################
+
+def _run_on_pool(func, *args):
+    if _hash_pool is None:
+        return func(*args)
+    else:
+        return _hash_pool.submit(func, *args).result()
+
+def hash_password(password):
+    return _run_on_pool(generate_password_hash, password, _hash_method)
+
+def check_password(pwhash, password):
+    return _run_on_pool(check_password_hash, pwhash, password)
+
+@lru_cache
+def _method_parameters(method):
+    # The method with the default parameters filled in, as it appears at the start of a hash
+    return generate_password_hash('', method).split('$', 1)[0]
+
+def needs_rehash(pwhash):
+    """
+    Return True if ``pwhash`` was not made with the current hash method and parameters.
+    """
+    return pwhash.split('$', 1)[0] != _method_parameters(_hash_method)
+
+######################
+### Access control ###
+######################
+
 def required(auth_level):
     def wrap_func(func):
         @wraps(func)
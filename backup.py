@@ -0,0 +1,269 @@
+import os, re, gzip, shutil, sqlite3, datetime, threading, tempfile, time
+import click
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+import config, database
+from database import db
+
+__all__ = ['backup', 'list_backups', 'rotate', 'verify', 'restore']
+
+FILENAME = re.compile(r'^backup-(\d{8}-\d{6})\.db(\.gz)?$')
+
+_app = None
+_scheduler = None
+
+def init(app):
+    globals()['_app'] = app
+
+    @app.cli.group('backup')
+    def backup_command():
+        """Back up and restore the database."""
+
+    @backup_command.command('create')
+    def create_command():
+        """Make a backup of the database now."""
+        path = backup()
+        click.echo(f'Wrote {path}')
+
+    @backup_command.command('list')
+    def list_command():
+        """List the backups, newest first."""
+        for path, created in list_backups():
+            click.echo(f'{created:%Y-%m-%d %H:%M:%S}  {os.path.getsize(path):>12,}  {path}')
+
+    @backup_command.command('restore')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.confirmation_option(prompt='This replaces all the data in the database. Continue?')
+    def restore_command(path):
+        """Replace the database with a backup. The backup is verified first."""
+        safety_copy = restore(path)
+        click.echo(f'Restored {path}. The database before the restore was backed up to {safety_copy}.')
+        click.echo('Restart the app so that the workers drop their caches.')
+
+    interval = app.config.get('BACKUP_INTERVAL', 0)
+    if interval and not app.testing:
+        start_scheduler(interval)
+
+def _config(key):
+    # The defaults are those of config.Config
+    default = getattr(config.Config, key)
+    return _app.config.get(key, default) if _app is not None else default
+
+def _backupdir():
+    return _config('BACKUP_DIR')
+
+##############
+### Backup ###
+##############
+
+def list_backups(directory=None):
+    """
+    Return a list of ``(path, created)`` for the backups in ``directory``, newest first.
+    """
+    directory = directory or _backupdir()
+    if not os.path.isdir(directory):
+        return []
+
+    backups = []
+    for name in os.listdir(directory):
+        if m := FILENAME.match(name):
+            backups.append((os.path.join(directory, name), datetime.datetime.strptime(m.group(1), '%Y%m%d-%H%M%S')))
+    return sorted(backups, key=lambda backup: backup[1], reverse=True)
+
+@database.with_app_context
+def backup(directory=None, compress=None):
+    """
+    Copy the database to a new file in ``directory`` and return its path.
+
+    The copy is made with SQLite's online backup API, ``BACKUP_PAGES`` pages at a time with a pause of
+    ``BACKUP_PAUSE`` seconds in between, so that requests can use the database while it is copied. The copy is
+    checked with ``PRAGMA integrity_check`` and then gzip compressed if ``compress``, or ``BACKUP_COMPRESS``,
+    is True. Old backups are removed according to the retention settings afterwards.
+    """
+    directory = directory or _backupdir()
+    path = _copy(directory, compress)
+    rotate(directory)
+    return path
+
+def _copy(directory, compress):
+    compress = _config('BACKUP_COMPRESS') if compress is None else compress
+    pages, pause = _config('BACKUP_PAGES'), _config('BACKUP_PAUSE')
+    os.makedirs(directory, exist_ok=True)
+
+    created = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    path = os.path.join(directory, f'backup-{created:%Y%m%d-%H%M%S}.db')
+    while os.path.exists(path) or os.path.exists(path + '.gz'):
+        created += datetime.timedelta(seconds=1)
+        path = os.path.join(directory, f'backup-{created:%Y%m%d-%H%M%S}.db')
+
+    temp = path + '.partial'
+    source = db.engine.raw_connection()
+    try:
+        target = sqlite3.connect(temp)
+        try:
+            source.driver_connection.backup(target, pages=pages, progress=lambda *args: time.sleep(pause))
+            _check(target)
+        finally:
+            target.close()
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+    finally:
+        source.close()
+
+    if compress:
+        with open(temp, 'rb') as file, gzip.open(temp + '.gz', 'wb') as gzfile:
+            shutil.copyfileobj(file, gzfile)
+        os.remove(temp)
+        temp, path = temp + '.gz', path + '.gz'
+    os.replace(temp, path)
+    return path
+
+def rotate(directory=None, keep_last=None, keep_daily=None, keep_weekly=None, exclude=()):
+    """
+    Remove old backups from ``directory`` and return the paths of the removed backups.
+
+    The newest ``keep_last`` backups are kept, as well as the newest backup of each of the last ``keep_daily``
+    days and of each of the last ``keep_weekly`` weeks that have backups. The paths in ``exclude`` are never
+    removed.
+    """
+    keep_last = _config('BACKUP_KEEP_LAST') if keep_last is None else keep_last
+    keep_daily = _config('BACKUP_KEEP_DAILY') if keep_daily is None else keep_daily
+    keep_weekly = _config('BACKUP_KEEP_WEEKLY') if keep_weekly is None else keep_weekly
+
+    backups = list_backups(directory)
+    keep = {path for path, created in backups[:keep_last]}
+    for period, count in [(lambda created: created.date(), keep_daily),
+                          (lambda created: created.isocalendar()[:2], keep_weekly)]:
+        newest = {}
+        for path, created in backups:
+            newest.setdefault(period(created), path)
+        keep.update(list(newest.values())[:count])
+
+    exclude = {os.path.abspath(path) for path in exclude}
+    removed = []
+    for path, created in backups:
+        if path not in keep and os.path.abspath(path) not in exclude:
+            os.remove(path)
+            removed.append(path)
+    return removed
+
+#################
+### Scheduler ###
+#################
+
+def _run_scheduled(interval):
+    directory = _backupdir()
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, '.lock'), 'w') as lock:
+        # Only one of the worker processes makes the backup
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return None
+
+        backups = list_backups(directory)
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        if backups and (now - backups[0][1]).total_seconds() < interval * 0.9:
+            return None
+        return backup(directory)
+
+def start_scheduler(interval):
+    """
+    Start a daemon thread that makes a backup every ``interval`` seconds.
+    """
+    if _scheduler is not None:
+        return _scheduler
+
+    stop = threading.Event()
+    def run():
+        while not stop.wait(interval):
+            try:
+                _run_scheduled(interval)
+            except Exception:
+                _app.logger.exception('Scheduled backup failed')
+
+    thread = threading.Thread(target=run, name='backup-scheduler', daemon=True)
+    thread.stop = stop
+    thread.start()
+    globals()['_scheduler'] = thread
+    return thread
+
+###############
+### Restore ###
+###############
+
+def _check(connection):
+    result = connection.execute('PRAGMA integrity_check').fetchone()[0]
+    if result != 'ok':
+        raise ValueError(f'The integrity check failed: {result}')
+
+def _open_backup(path):
+    # Returns a connection to the backup and the path of a temporary file to remove after, if any
+    if not path.endswith('.gz'):
+        return sqlite3.connect(f'file:{path}?mode=ro', uri=True), None
+
+    with tempfile.NamedTemporaryFile(suffix='.db', delete=False) as file, gzip.open(path, 'rb') as gzfile:
+        shutil.copyfileobj(gzfile, file)
+    return sqlite3.connect(file.name), file.name
+
+def verify(path):
+    """
+    Check that ``path`` is an intact backup of this database. Raises ``ValueError`` if it is not.
+    """
+    try:
+        connection, temp = _open_backup(path)
+    except (OSError, EOFError) as err:
+        raise ValueError(f'Cannot read the backup: {err}')
+    try:
+        _check(connection)
+        tables = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        if missing := set(db.metadata.tables) - tables:
+            raise ValueError(f'The backup is missing the tables {", ".join(sorted(missing))}')
+    except sqlite3.DatabaseError as err:
+        raise ValueError(f'The backup is not a valid database: {err}')
+    finally:
+        connection.close()
+        if temp is not None:
+            os.remove(temp)
+
+@database.with_app_context
+def restore(path):
+    """
+    Replace the contents of the database with the backup at ``path`` after verifying it.
+
+    A backup of the database is made first and its path is returned. Old backups are only removed after the
+    restore, and ``path`` never is. The generation is moved past both that of the database and of the backup
+    so that no cached response or data from either is reused.
+    """
+    verify(path)
+    directory = _backupdir()
+    safety_copy = _copy(directory, None)
+    generation, data_generation = database.generation(), database.generation(data=True)
+
+    connection, temp = _open_backup(path)
+    target = db.engine.raw_connection()
+    try:
+        connection.backup(target.driver_connection)
+    finally:
+        target.close()
+        connection.close()
+        if temp is not None:
+            os.remove(temp)
+
+    db.session.expire_all()
+    database.Attrs.set('generation', max(generation, database.generation()) + 1)
+    database.Attrs.set('data_generation', max(data_generation, database.generation(data=True)) + 1)
+    database.search_index.clear()
+    database.facet_cache.clear()
+    database.autocomplete.clear()
+    database.user_cache.clear()
+
+    rotate(directory, exclude=[path])
+    return safety_copy
@@ -0,0 +1,48 @@
+"""
+Per call overhead of the data layer with and without reusing the current app context.
+
+Run from the repository root with ``python benchmarks/bench_app_context.py``.
+"""
+import os, sys, tempfile, timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+import config
+
+def main(number=2000):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config.Test.SQLALCHEMY_DATABASE_URI = f"sqlite:///{os.path.join(tmpdir, 'bench.db')}"
+        from app import create_app
+        import database
+
+        app = create_app(testing=True)
+        with app.app_context():
+            database.db.create_all()
+        database.Attrs.set('generation', 0)
+
+        @database.with_app_context
+        def noop():
+            pass
+
+        calls = dict(noop=noop,
+                     attrs_get=lambda: database.Attrs.get('generation'),
+                     user_get_one=lambda: database.User.get_one(id=1, or_none=True))
+
+        print(f'{"call":<15}{"new context":>15}{"reused context":>18}')
+        for name, func in calls.items():
+            def new_context():
+                # What every call did before, push a new app context and session
+                with app.app_context():
+                    func()
+
+            new = timeit.timeit(new_context, number=number) / number
+            with app.test_request_context():
+                reused = timeit.timeit(func, number=number) / number
+            print(f'{name:<15}{new * 1e6:>12.1f} us{reused * 1e6:>15.1f} us')
+
+        with app.app_context():
+            database.db.engine.dispose()
+
+if __name__ == '__main__':
+    main()
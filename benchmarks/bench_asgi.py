@@ -0,0 +1,117 @@
+"""
+Requests per second and latency of the search page with slow clients, served by a pool of sync workers and
+by asgi.py with the same number of threads.
+
+A sync worker is held while the client downloads the response, in asgi.py only the event loop waits. The
+clients download at ``--bandwidth`` bytes per second.
+
+Run from the repository root with ``python benchmarks/bench_asgi.py``.
+"""
+import os, sys, io, time, tempfile, asyncio, threading, statistics, argparse
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+import config
+
+def make_rows(n):
+    return [(i, dict(authors=f'Author{i}, A.; Author{i + 1}, B.', year=str(1950 + i % 70),
+                     journal='Geochimica et Cosmochimica Acta', doi=f'10.1016/j.gca.{i}', ads='',
+                     sample_type=('CAI', 'Chondrule', 'Presolar grain')[i % 3], element='Mo, Pd, Ru'))
+            for i in range(n)]
+
+def scope(path, query_string):
+    return dict(type='http', method='GET', path=path, query_string=query_string, root_path='', headers=[],
+                scheme='http', http_version='1.1', server=('localhost', 80), client=('127.0.0.1', 5000))
+
+def report(name, latencies, elapsed):
+    latencies = sorted(latencies)
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f'{name:<6}{len(latencies) / elapsed:>10.1f}{statistics.median(latencies) * 1e3:>12.1f} ms'
+          f'{p99 * 1e3:>12.1f} ms')
+
+def run_sync(flask_app, asgi, workers, clients, requests, bandwidth, path, query_string):
+    pool = ThreadPoolExecutor(max_workers=workers)
+
+    def handle():
+        def start_response(status, headers, exc_info=None):
+            pass
+        chunks = flask_app(asgi.environ(scope(path, query_string), io.BytesIO()), start_response)
+        try:
+            for chunk in chunks:
+                time.sleep(len(chunk) / bandwidth)  # Writing to the slow client blocks the worker
+        finally:
+            chunks.close()
+
+    latencies = []
+    def client():
+        for i in range(requests):
+            start = time.perf_counter()
+            pool.submit(handle).result()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report('sync', latencies, time.perf_counter() - start)
+    pool.shutdown()
+
+def run_asgi(flask_app, asgi, workers, clients, requests, bandwidth, path, query_string):
+    asgi_app = asgi.ASGIApp(flask_app, read_paths=('/search',), read_workers=workers, write_workers=1)
+    latencies = []
+
+    async def client():
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        async def send(message):
+            await asyncio.sleep(len(message.get('body', b'')) / bandwidth)
+
+        for i in range(requests):
+            start = time.perf_counter()
+            await asgi_app(scope(path, query_string), receive, send)
+            latencies.append(time.perf_counter() - start)
+
+    async def main():
+        await asyncio.gather(*[client() for i in range(clients)])
+
+    start = time.perf_counter()
+    asyncio.run(main())
+    report('asgi', latencies, time.perf_counter() - start)
+
+def main(workers, clients, requests, bandwidth, rows):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config.Test.SQLALCHEMY_DATABASE_URI = f"sqlite:///{os.path.join(tmpdir, 'bench.db')}"
+        import asgi, database, importer
+        from app import create_app
+
+        flask_app = create_app(testing=True)
+        with flask_app.app_context():
+            database.db.create_all()
+        user = database.User.new_user('bench', 'bench@test.com', 'password')
+        importer.import_rows(user.id, make_rows(rows))
+
+        path, query_string = '/search', b'sample_type=CAI'
+        with flask_app.test_client() as client:
+            size = len(client.get(path, query_string=query_string.decode()).get_data())
+        print(f'{workers} workers, {clients} clients, {size / 1000:.0f} kB pages at {bandwidth / 1000:.0f} kB/s')
+        print(f'{"":<6}{"req/s":>10}{"p50":>15}{"p99":>15}')
+
+        run_sync(flask_app, asgi, workers, clients, requests, bandwidth, path, query_string)
+        run_asgi(flask_app, asgi, workers, clients, requests, bandwidth, path, query_string)
+
+        with flask_app.app_context():
+            database.db.engine.dispose()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=3, help='Requests made by each client')
+    parser.add_argument('--bandwidth', type=float, default=250_000, help='bytes per second of each client')
+    parser.add_argument('--rows', type=int, default=3000)
+    args = parser.parse_args()
+    main(args.workers, args.clients, args.requests, args.bandwidth, args.rows)
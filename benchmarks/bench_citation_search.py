@@ -0,0 +1,68 @@
+"""
+Time of a free text citation search with 100k citations, with the FTS5 index and with a LIKE scan of the
+authors, journal and doi, which is how the edit table searches.
+
+Run from the repository root with ``python benchmarks/bench_citation_search.py``.
+"""
+import os, sys, time, tempfile, random, argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+import config
+
+NAMES = ['Ek', 'Hunt', 'Lugaro', 'Schonbachler', 'Budde', 'Burkhardt', 'Toth', 'Fehr', 'Friebel', 'Nanne',
+         'Shollenberger', 'Brennecka', 'Kleine', 'Render', 'Akram', 'Dauphas', 'Chen', 'Qin', 'Yokoyama', 'Walker']
+JOURNALS = ['Nature Astronomy', 'Earth and Planetary Science Letters', 'Geochimica et Cosmochimica Acta',
+            'The Astrophysical Journal', 'Meteoritics & Planetary Science']
+
+def make_citations(n, seed=0):
+    rng = random.Random(seed)
+    for i in range(n):
+        authors = '; '.join(f'{rng.choice(NAMES)}{rng.randrange(500)}, {chr(65 + rng.randrange(26))}'
+                            for j in range(rng.randint(1, 6)))
+        yield dict(id=i + 1, creator_id=1, authors=authors, year=1950 + i % 70, journal=rng.choice(JOURNALS),
+                   doi=f'10.1016/j.gca.{i}', ads='')
+
+def timed(func, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        result = func()
+    return (time.perf_counter() - start) / repeat, result
+
+def main(citations, repeat):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config.Test.SQLALCHEMY_DATABASE_URI = f"sqlite:///{os.path.join(tmpdir, 'bench.db')}"
+        import database
+        from app import create_app
+
+        app = create_app(testing=True)
+        with app.app_context():
+            db = database.db
+            db.create_all()
+            db.session.execute(db.insert(database.Citation), list(make_citations(citations)))
+            db.session.commit()
+
+            def like(text):
+                query = db.select(db.func.count()).select_from(database.Citation)
+                for term in text.split():
+                    query = query.where(db.or_(database.Citation.authors.contains(term, autoescape=True),
+                                               database.Citation.journal.contains(term, autoescape=True),
+                                               database.Citation.doi.contains(term, autoescape=True)))
+                return db.session.execute(query).scalar()
+
+            print(f'{citations} citations')
+            print(f'{"query":<26}{"matches":>10}{"fts5":>12}{"like":>12}')
+            for text in ['Schonbachler1', 'lugaro42 nature', 'hunt', 'gca.4242', 'no such author']:
+                fts, (total, results) = timed(lambda: database.Citation.search_text(text), repeat)
+                scan, count = timed(lambda: like(text), repeat)
+                print(f'{text:<26}{total:>10}{fts * 1e3:>9.2f} ms{scan * 1e3:>9.2f} ms')
+
+            db.engine.dispose()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--citations', type=int, default=100_000)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+    main(args.citations, args.repeat)
@@ -0,0 +1,71 @@
+"""
+Login throughput, and the latency of a search made at the same time, for a number of request workers.
+
+Each worker is a thread that verifies passwords in a loop, like a burst of logins to a threaded server.
+Hashing runs on the pool of PASSWORD_HASH_WORKERS threads so adding workers should not slow down searches
+more than that many logins do. The baseline hashes on the worker threads, like the same number of sync
+workers would, each hashing on its own.
+
+Run from the repository root with ``python benchmarks/bench_login.py [--method METHOD] [--pool N]``.
+"""
+import os, sys, tempfile, threading, time, argparse, statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+import config
+
+def main(method, pool, workers=(1, 2, 4, 8), duration=3):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config.Test.SQLALCHEMY_DATABASE_URI = f"sqlite:///{os.path.join(tmpdir, 'bench.db')}"
+        config.Test.PASSWORD_HASH_METHOD = method
+        from app import create_app
+        import database, auth
+
+        app = create_app(testing=True)
+        with app.app_context():
+            database.db.create_all()
+        user = database.User.new_user('bench', 'bench@test.com', 'password')
+
+        print(f'method={method}')
+        print(f'{"hashing":>12}{"workers":>8}{"logins/s":>12}{"search p50":>14}')
+        for size, n in [(size, n) for size in (0, pool) for n in workers]:
+            app.config['PASSWORD_HASH_WORKERS'] = size
+            auth.init(app)
+            stop = threading.Event()
+            logins = []
+
+            def login():
+                count = 0
+                while not stop.is_set():
+                    assert database.User.verify_password(user.id, 'password')
+                    count += 1
+                logins.append(count)
+
+            threads = [threading.Thread(target=login) for i in range(n)]
+            for thread in threads:
+                thread.start()
+
+            latencies, start = [], time.perf_counter()
+            while time.perf_counter() - start < duration:
+                t = time.perf_counter()
+                database.Data.get_search(use_index=False)
+                latencies.append(time.perf_counter() - t)
+                time.sleep(0.01)
+
+            stop.set()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            hashing = f'pool of {size}' if size else 'baseline'
+            print(f'{hashing:>12}{n:>8}{sum(logins) / elapsed:>12.1f}{statistics.median(latencies) * 1e3:>11.2f} ms')
+
+        with app.app_context():
+            database.db.engine.dispose()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--method', default=config.Config.PASSWORD_HASH_METHOD)
+    parser.add_argument('--pool', type=int, default=config.Config.PASSWORD_HASH_WORKERS)
+    args = parser.parse_args()
+    main(args.method, args.pool)
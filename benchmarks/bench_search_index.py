@@ -0,0 +1,75 @@
+"""
+Time of a search with 100k citations and three data rows each, with the in-memory search index and with the
+``SELECT DISTINCT citation_id`` query it replaces, and of the whole ``Data.get_search`` with and without it.
+
+Run from the repository root with ``python benchmarks/bench_search_index.py``.
+"""
+import os, sys, time, tempfile, random, argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+import config
+
+SAMPLE_TYPES = ['CAI', 'Chondrule', 'Wholerock', 'Leachate', 'Matrix', 'Presolar grain']
+ELEMENTS = ['Mo', 'Pd', 'Ru', 'Zr', 'Ti', 'Cr', 'Ni', 'Ca', 'Ba', 'Nd', 'Sm', 'W']
+
+def make_rows(citations, rows, seed=0):
+    rng = random.Random(seed)
+    citation_rows = [dict(id=i + 1, creator_id=1, authors=f'Author{i}, A.', year=1950 + i % 70,
+                          journal='Geochimica et Cosmochimica Acta', doi=f'10.1016/j.gca.{i}', ads='')
+                     for i in range(citations)]
+    data_rows = [dict(citation_id=i // rows + 1, creator_id=1, sample_type=rng.choice(SAMPLE_TYPES),
+                      element=rng.choice(ELEMENTS))
+                 for i in range(citations * rows)]
+    return citation_rows, data_rows
+
+def timed(func, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        result = func()
+    return (time.perf_counter() - start) / repeat, result
+
+def main(citations, rows, repeat):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config.Test.SQLALCHEMY_DATABASE_URI = f"sqlite:///{os.path.join(tmpdir, 'bench.db')}"
+        import database
+        from app import create_app
+
+        app = create_app(testing=True)
+        with app.app_context():
+            db = database.db
+            db.create_all()
+            citation_rows, data_rows = make_rows(citations, rows)
+            db.session.execute(db.insert(database.Citation), citation_rows)
+            db.session.execute(db.insert(database.Data), data_rows)
+            db.session.commit()
+
+            build, _ = timed(database.search_index.build, 1)
+            print(f'{citations} citations, {citations * rows} data rows, index built in {build * 1e3:.0f} ms')
+
+            def sql(**where):
+                query, _ = database.Data.get_query('citation_id', **where)
+                return db.session.execute(query.distinct().order_by(database.Data.citation_id)).scalars().all()
+
+            print(f'{"search":<42}{"matches":>9}{"index":>12}{"sql":>12}{"get_search":>14}{"no index":>12}')
+            for where in [dict(element=['Mo']), dict(element=['Mo', 'Pd'], sample_type=['CAI']),
+                          dict(sample_type=['Presolar grain']), dict(element=['Xx'])]:
+                index, citation_ids = timed(lambda: database.search_index.search(**where), repeat)
+                scan, expected = timed(lambda: sql(**where), repeat)
+                assert citation_ids == expected
+                full, _ = timed(lambda: database.Data.get_search(**where), 1)
+                full_scan, _ = timed(lambda: database.Data.get_search(use_index=False, **where), 1)
+                description = ', '.join(f'{key}={value}' for key, value in where.items())
+                print(f'{description:<42}{len(citation_ids):>9}{index * 1e3:>9.1f} ms{scan * 1e3:>9.1f} ms'
+                      f'{full * 1e3:>11.0f} ms{full_scan * 1e3:>9.0f} ms')
+
+            db.engine.dispose()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--citations', type=int, default=100_000)
+    parser.add_argument('--rows', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    main(args.citations, args.rows, args.repeat)
@@ -0,0 +1,73 @@
+"""
+CPU time and peak memory of rendering a client side table with 1k, 10k and 100k rows.
+
+``concatenated`` is how the table data was built before, by concatenating a JavaScript object literal for
+each row. ``json`` is ``render.table``, a single JSON encode of the row arrays.
+
+Run from the repository root with ``python benchmarks/bench_table.py``.
+"""
+import os, sys, time, tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+HEADINGS = ('Authors', 'Year', 'Journal', 'Sample Type', 'Element', 'Link')
+RESULT_TYPES = {'Link': 'html'}
+
+def make_rows(n):
+    return [(f'Author{i}, A.; Author{i + 1}, B.', 1950 + i % 70, 'Geochimica et Cosmochimica Acta',
+             'CAI, Chondrule', 'Mo, Pd, Ru', f'<a href="https://doi.org/10.1016/j.gca.{i}">DOI</a>')
+            for i in range(n)]
+
+def concatenated(headings, results, result_types):
+    heading_ids = [heading.replace(' ', '_') for heading in headings]
+    data = []
+    for row in results:
+        row_data = ''
+        for i, column in enumerate(row):
+            result_type = result_types.get(headings[i], None)
+            if result_type == 'html':
+                column = f"gridjs.html('{column}')"
+            elif result_type == 'number' or (result_type is None and isinstance(column, (int, float))):
+                column = f"{column}"
+            else:
+                column = f'"{column}"'
+            row_data += f"{heading_ids[i]}: {column},\n"
+        data.append(f"{{\n{row_data}}}, \n")
+    return ''.join(data)
+
+def measure(func):
+    # Tracing the memory slows everything down so the time is measured separately
+    start = time.process_time()
+    result = func()
+    elapsed = time.process_time() - start
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, len(result)
+
+def main():
+    from app import create_app
+    import render
+
+    app = create_app(testing=True)
+    with app.test_request_context():
+        render.table('table.html', HEADINGS, make_rows(10), result_types=RESULT_TYPES)  # Compile the template
+
+    print(f'{"rows":>8}{"method":>14}{"cpu":>12}{"peak memory":>14}{"size":>12}')
+    for n in (1_000, 10_000, 100_000):
+        rows = make_rows(n)
+        for name, func in [('concatenated', lambda: concatenated(HEADINGS, rows, RESULT_TYPES)),
+                           ('json', lambda: render.script_json(rows))]:
+            elapsed, peak, size = measure(func)
+            print(f'{n:>8}{name:>14}{elapsed * 1e3:>9.1f} ms{peak / 2**20:>11.1f} MB{size / 2**20:>9.1f} MB')
+
+        with app.test_request_context():
+            elapsed, peak, size = measure(lambda: render.table('table.html', HEADINGS, rows,
+                                                               result_types=RESULT_TYPES))
+        print(f'{n:>8}{"render.table":>14}{elapsed * 1e3:>9.1f} ms{peak / 2**20:>11.1f} MB{size / 2**20:>9.1f} MB')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+import os, gzip, zlib, mimetypes
+import click
+import flask
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+__all__ = ['ENCODINGS', 'accepted_encoding', 'compress', 'compress_static']
+
+# encoding: file extension of the precompressed static files
+ENCODINGS = {'br': '.br', 'gzip': '.gz'}
+
+_config = dict(COMPRESS_MIN_SIZE=1024,
+               COMPRESS_LEVEL=6,
+               COMPRESS_BROTLI_QUALITY=5,
+               COMPRESS_MIMETYPES=('text/html', 'text/css', 'text/javascript', 'application/javascript',
+                                   'application/json', 'application/x-ndjson', 'text/csv',
+                                   'application/x-bibtex'))
+
+def init(app):
+    for key, default in _config.items():
+        _config[key] = app.config.get(key, default)
+
+    @app.after_request
+    def compress_response(response):
+        return compress(response)
+
+    # Serve the precompressed version of a static file if there is one
+    static_view = app.view_functions['static']
+    def static(filename):
+        if response := _send_precompressed(app.static_folder, filename):
+            return response
+        return static_view(filename=filename)
+    app.view_functions['static'] = static
+
+    @app.cli.command('compress-static')
+    def compress_static_command():
+        """Write a gzip, and brotli if available, compressed copy of each static file."""
+        for path in compress_static(app.static_folder):
+            click.echo(f'Compressed {path}')
+
+def accepted_encoding():
+    """
+    Return the preferred encoding of the request that we support, or ``None``.
+    """
+    accept = flask.request.accept_encodings
+    for encoding in ENCODINGS:
+        if encoding == 'br' and brotli is None:
+            continue
+        if accept[encoding] > 0:
+            return encoding
+    return None
+
+def _compressor(encoding):
+    # Returns a (compress, flush) tuple for incremental compression
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=_config['COMPRESS_BROTLI_QUALITY'])
+        return compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(_config['COMPRESS_LEVEL'], zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip
+        return compressor.compress, compressor.flush
+
+def _compress_iter(chunks, encoding):
+    compress, flush = _compressor(encoding)
+    for chunk in chunks:
+        if type(chunk) is str:
+            chunk = chunk.encode()
+        if data := compress(chunk):
+            yield data
+    yield flush()
+
+def compress(response):
+    """
+    Compress ``response`` with the preferred encoding of the request if it is text or JSON larger than
+    ``COMPRESS_MIN_SIZE``. Streamed responses are compressed as they are sent.
+    """
+    if (response.status_code != 200 or response.direct_passthrough
+            or response.mimetype not in _config['COMPRESS_MIMETYPES']
+            or 'Content-Encoding' in response.headers or response.cache_control.no_transform):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    if not response.is_streamed and response.calculate_content_length() < _config['COMPRESS_MIN_SIZE']:
+        return response
+    if (encoding := accepted_encoding()) is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_iter(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        compress, flush = _compressor(encoding)
+        response.set_data(compress(response.get_data()) + flush())
+
+    response.headers['Content-Encoding'] = encoding
+    # The compressed response is not byte for byte the same as the uncompressed one
+    if response.get_etag()[0] is not None:
+        response.set_etag(response.get_etag()[0], weak=True)
+    return response
+
+def _send_precompressed(folder, filename):
+    path = safe_join(folder, filename)
+    if path is None or not os.path.isfile(path):
+        return None
+
+    accept = flask.request.accept_encodings
+    for encoding, extension in ENCODINGS.items():
+        compressed_path = path + extension
+        # Ignore copies older than the file, they were made before it was changed
+        if (accept[encoding] > 0 and os.path.isfile(compressed_path)
+                and os.path.getmtime(compressed_path) >= os.path.getmtime(path)):
+            response = flask.send_file(compressed_path, mimetype=mimetypes.guess_type(path)[0],
+                                       max_age=flask.current_app.get_send_file_max_age(filename),
+                                       conditional=True)
+            response.headers['Content-Encoding'] = encoding
+            response.vary.add('Accept-Encoding')
+            return response
+    return None
+
+def compress_static(folder):
+    """
+    Write a compressed copy of each file in ``folder`` with a compressible mimetype next to the file.
+    Returns the paths of the files that were compressed.
+    """
+    paths = []
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            path = os.path.join(root, name)
+            if name.endswith(tuple(ENCODINGS.values())) or mimetypes.guess_type(path)[0] not in _config['COMPRESS_MIMETYPES']:
+                continue
+
+            with open(path, 'rb') as file:
+                data = file.read()
+            with open(path + ENCODINGS['gzip'], 'wb') as file:
+                file.write(gzip.compress(data, 9, mtime=0))
+            if brotli is not None:
+                with open(path + ENCODINGS['br'], 'wb') as file:
+                    file.write(brotli.compress(data, quality=11))
+            paths.append(path)
+    return paths
@@ -7,6 +7,7 @@ backupdir = os.path.join(instancedir, 'backups')
 load_dotenv(os.path.join(instancedir, 'chies.env'))
 db_path = os.path.join(instancedir, 'database.db')
 test_db_path = os.path.join(basedir, 'tests', 'files', 'testdb.db')
+snapshot_path = os.path.join(instancedir, 'search.snapshot')
 
 class Config:
     FLASK_APP = os.environ.get("FLASK_APP")
@@ -15,9 +16,64 @@ class Config:
     RECAPTCHA_PRIVATE_KEY = os.environ.get('RECAPTCHA_PRIVATE_KEY')
     RECAPTCHA_PUBLIC_KEY = os.environ.get('RECAPTCHA_PUBLIC_KEY')
     SQLALCHEMY_DATABASE_URI=f"sqlite:///{db_path}"
+    SQLALCHEMY_ENGINE_OPTIONS = dict(pool_size=int(os.environ.get('DB_POOL_SIZE', 5)),
+                                     max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+                                     pool_timeout=30)
+
+    # Set on every new SQLite connection. With WAL readers don't block writers and writers don't block readers.
+    SQLITE_PRAGMAS = dict(journal_mode='wal',
+                          synchronous='normal',  # Safe with WAL, only the last transactions can be lost on power loss
+                          busy_timeout=int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)),  # ms
+                          cache_size=-16000,  # kB
+                          mmap_size=128 * 1024 * 1024,
+                          temp_store='memory')
+
+    # Passwords are hashed with werkzeug. Hashes made with other parameters are upgraded on login.
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+    # The number of passwords that can be hashed at the same time by each threaded worker process, 0 for no limit.
+    # Logins still wait for their hash, this only caps the cores that logins can use.
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+
+    # Seconds a logged in user is cached before it is loaded from the database again
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 60))
+
+    # Compression of text and JSON responses. Brotli is used if the brotli package is installed.
+    COMPRESS_MIN_SIZE = 1024  # bytes
+    COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))  # gzip, 1-9
+    COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 5))  # 0-11
+
+    # Backups of the database, see backup.py. A backup is made every BACKUP_INTERVAL seconds, 0 to disable.
+    BACKUP_DIR = backupdir
+    BACKUP_INTERVAL = int(os.environ.get('BACKUP_INTERVAL', 6 * 60 * 60))
+    BACKUP_COMPRESS = True
+    BACKUP_PAGES = 256  # Pages copied at a time
+    BACKUP_PAUSE = 0.01  # Seconds between copying pages
+    BACKUP_KEEP_LAST = 8  # The newest backups that are always kept
+    BACKUP_KEEP_DAILY = 7  # Days for which the newest backup of the day is kept
+    BACKUP_KEEP_WEEKLY = 8  # Weeks for which the newest backup of the week is kept
+
+    # Convert the markdown of pages that doesn't change between requests when the app is created
+    MARKDOWN_PRECOMPILE = True
+
+    # How searches find the matching citations. 'index' keeps an index in the memory of each worker process,
+    # 'snapshot' shares a memory mapped copy of the data, stored at SEARCH_SNAPSHOT_PATH, between the workers,
+    # and requires numpy.
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'index')
+    SEARCH_SNAPSHOT_PATH = snapshot_path
+
+    # Serving with asgi.py. GET requests for these paths, or paths starting with those ending with *, run on
+    # the read pool, everything else on the write pool. Keep the pools within the database connection pool size.
+    ASGI_READ_PATHS = ('/', '/search', '/citations', '/citations/data', '/export', '/dm/citations',
+                       '/dm/complete/*', '/dm/edit/data', '/admin/all_edits', '/static/*')
+    ASGI_READ_WORKERS = int(os.environ.get('ASGI_READ_WORKERS', 8))
+    ASGI_WRITE_WORKERS = int(os.environ.get('ASGI_WRITE_WORKERS', 2))
+
+    # Apply new migrations to an existing database when the app is created
+    MIGRATE_ON_STARTUP = True
 
 
 class Test(Config):
     TESTING = True
     WTF_CSRF_ENABLED = False
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
     SQLALCHEMY_DATABASE_URI = f"sqlite:///{test_db_path}"
\ No newline at end of file
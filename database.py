@@ -1,16 +1,20 @@
+import flask
+import sqlalchemy
 from flask_sqlalchemy import SQLAlchemy
 import os
 from flask_login import UserMixin, AnonymousUserMixin
+import functools
 from functools import wraps
-from werkzeug.security import check_password_hash, generate_password_hash
-import re, datetime
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+import re, json, datetime, time, itertools, threading, contextlib, contextvars, bisect
 
 import auth
 import database
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
-db = SQLAlchemy()
+# Objects stay usable after the commit of a transaction without being loaded again
+db = SQLAlchemy(session_options={'expire_on_commit': False})
 _app = None
 
 """
@@ -27,6 +31,21 @@ Data.query(Data.query.filter(Data.element.in_([list])
 def init(app):
     db.init_app(app)
     globals()['_app'] = app
+    user_cache.ttl = app.config.get('USER_CACHE_TTL', user_cache.ttl)
+
+    with app.app_context():
+        if db.engine.dialect.name == 'sqlite':
+            pragmas = app.config.get('SQLITE_PRAGMAS', {})
+            sqlalchemy.event.listen(db.engine, 'connect', lambda connection, record: set_pragmas(connection, pragmas))
+
+    # The app context, and so g, outlives the request when it was pushed before it
+    app.teardown_request(_forget_generations)
+
+def set_pragmas(connection, pragmas):
+    cursor = connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
 
 def add(model_item):
     db.session.add(model_item)
@@ -34,19 +53,120 @@ def add(model_item):
 def commit():
     db.session.commit()
 
+def flush():
+    db.session.flush()
+
 def delete(item):
     db.session.delete(item)
 
+# Functions called as listener(action, item, changes) whenever an entry is created, updated or deleted.
+# changes is a dict of {column: (old_value, new_value)} for updates and None otherwise.
+_write_listeners = []
+
+def on_write(func):
+    _write_listeners.append(func)
+    return func
+
+def written(action, item, changes=None):
+    for listener in _write_listeners:
+        listener(action, item, changes)
+
+# Functions called as listener(entries) when many entries are created at once, e.g. by an import. entries is a
+# dict of {table: [values]} with a dict of the column values of each created entry.
+_bulk_create_listeners = []
+
+def on_bulk_create(func):
+    _bulk_create_listeners.append(func)
+    return func
+
+def bulk_created(entries):
+    for listener in _bulk_create_listeners:
+        listener(entries)
+
+# Functions called without arguments when a transaction is rolled back, for listeners that keep
+# state outside the database.
+_rollback_listeners = []
+
+def on_rollback(func):
+    _rollback_listeners.append(func)
+    return func
+
+_transaction = contextvars.ContextVar('transaction', default=False)
+
+@contextlib.contextmanager
+def transaction():
+    """
+    All database calls made inside the block use the same session and are committed together at the end.
+
+    If an exception is raised nothing is committed. Nested blocks are part of the outermost block.
+    """
+    if _transaction.get():
+        yield
+        return
+
+    with _app_context():
+        token = _transaction.set(True)
+        try:
+            yield
+            commit()
+        except BaseException:
+            db.session.rollback()
+            for listener in _rollback_listeners:
+                listener()
+            raise
+        finally:
+            _transaction.reset(token)
+
+# Tables whose entries are held by the search index, the facets and the autocompletion
+DATA_TABLES = ('Citation', 'Data')
+
+def generation(data=False):
+    """
+    Return a number that changes every time an entry in the database is written.
+
+    If ``data`` is True the number only changes when an entry in one of the ``DATA_TABLES`` is written. The
+    caches of the data compare it to the generation they were built at to notice writes by other processes.
+    During a request both numbers are read once, and again only after the request has written.
+    """
+    key = 'data_generation' if data else 'generation'
+    if not flask.has_request_context():
+        return Attrs.get(key, 0, int)
+
+    if (generations := flask.g.get('_generations', None)) is None:
+        rows = db.session.execute(db.select(Attrs.key, Attrs.value)
+                                  .where(Attrs.key.in_(['generation', 'data_generation'])))
+        generations = flask.g._generations = {key: int(value) for key, value in rows}
+    return generations.get(key, 0)
+
+def _forget_generations(*args):
+    if flask.has_request_context():
+        flask.g.pop('_generations', None)
+
+def _app_context():
+    """
+    Return the app context database calls should be made in.
+
+    The current app context, e.g. that of the request, and its session is reused if there is one. A new
+    context is only pushed for calls made outside of the app, e.g. from scripts and CLI commands.
+    """
+    if _app is None:
+        raise RuntimeError('An app instance has not been initialised')
+
+    if flask.has_app_context() and flask.current_app._get_current_object() is _app:
+        return contextlib.nullcontext()
+    else:
+        return _app.app_context()
+
 def with_app_context(func):
     @wraps(func)
     def call_func_with_context(*args, **kwargs):
-        if _app is None:
-            raise RuntimeError('An app instance has not been initialised')
-        else:
-            with _app.app_context():
-                return func(*args, **kwargs)
+        if _transaction.get():
+            return func(*args, **kwargs)
+        with _app_context():
+            return func(*args, **kwargs)
     return call_func_with_context
 
+@functools.lru_cache(maxsize=None)
 def _get_table_field(default_table, name):
     def get_table(name):
         table = globals().get(name, None)
@@ -87,15 +207,18 @@ class AnonymousUser(AnonymousUserMixin):
     auth_level = 0
 
 
+# The statements built by ModelMixin.get_query for each table, what and where structure
+_query_cache = {}
+
 class ModelMixin:
     @classmethod
-    def get_query(cls, what=None, **where):
+    def _build_query(cls, what, where, distinct):
         # What
         if what is None:
             scalar = True
             query = db.select(cls)
         else:
-            if isinstance(what, (list, tuple)):
+            if isinstance(what, tuple):
                 scalar = False
             else:
                 scalar = True
@@ -105,7 +228,7 @@ class ModelMixin:
             items = []
             for w in what:
                 table, column = _get_table_field(cls, w)
-                if table is not cls:
+                if table is not cls and table not in join:
                     join.append(table)
                 items.append(column or table)
 
@@ -114,30 +237,74 @@ class ModelMixin:
                 query = query.join(j)
 
         # Where
+        for i, (key, op) in enumerate(where):
+            column = getattr(cls, key)
+            if op == 'eq':
+                query = query.where(column == db.bindparam(f'where_{i}'))
+            elif op == 'in':
+                query = query.where(column.in_(db.bindparam(f'where_{i}', expanding=True)))
+            else:
+                query = query.where(column.is_(None))
+
+        # Distinct
+        if distinct is True:
+            query = query.distinct()
+
+        return query, scalar
+
+    @classmethod
+    def _compiled_query(cls, what=None, where={}, distinct=False):
+        """
+        Return the statement for ``get_query``, whether it returns scalars and the values of its parameters.
+
+        Statements are cached by the columns in ``what`` and the keys and operators of ``where`` so that
+        repeated queries are not parsed and built again. The values of ``where`` are bound when executed.
+        """
+        if type(what) is list:
+            what = tuple(what)
+
+        operators, params = [], {}
         for key, value in where.items():
             if key.endswith('_eq'):
-                query = query.where(getattr(cls, key.removesuffix('_eq')) == value)
+                key, op = key.removesuffix('_eq'), 'eq' if value is not None else 'is'
             elif key.endswith('_in'):
-                query = query.where(getattr(cls, key.removesuffix('_in')).in_(value))
-            elif value is not None:
-                if type(value) is list:  # in
-                    if len(value) > 0:
-                        query = query.where(getattr(cls, key).in_(value))
-                elif type(value) is not str or (type(value) is str and len(value)) > 1:  # eq
-                    query = query.where(getattr(cls, key) == value)
+                key, op = key.removesuffix('_in'), 'in'
+            elif value is None:
+                continue
+            elif type(value) is list:  # in
+                if len(value) == 0:
+                    continue
+                op = 'in'
+            elif type(value) is not str or len(value) > 1:  # eq
+                op = 'eq'
+            else:
+                continue
+
+            if op != 'is':
+                params[f'where_{len(operators)}'] = value
+            operators.append((key, op))
+
+        cache_key = (cls, what, tuple(operators), distinct)
+        try:
+            query, scalar = _query_cache[cache_key]
+        except KeyError:
+            query, scalar = _query_cache[cache_key] = cls._build_query(what, operators, distinct)
+
+        return query, scalar, params
 
+    @classmethod
+    def get_query(cls, what=None, **where):
+        query, scalar, params = cls._compiled_query(what, where)
+        if params:
+            query = query.params(params)
         return query, scalar
 
     @classmethod
     @with_app_context
     def get_all(cls, what=None, *, distinct=False, **where):
-        query, scalar = cls.get_query(what, **where)
+        query, scalar, params = cls._compiled_query(what, where, distinct)
 
-        # Distinct
-        if distinct is True:
-            query = query.distinct()
-
-        result = db.session.execute(query)
+        result = db.session.execute(query, params)
         if scalar:
             result = result.scalars()
 
@@ -147,9 +314,9 @@ class ModelMixin:
     @classmethod
     @with_app_context
     def get_one(cls, what=None, *, or_none=False, **where):
-        query, scalar = cls.get_query(what, **where)
+        query, scalar, params = cls._compiled_query(what, where)
 
-        result = db.session.execute(query)
+        result = db.session.execute(query, params)
         if scalar:
             result = result.scalars()
 
@@ -160,33 +327,102 @@ class ModelMixin:
 
     @classmethod
     @with_app_context
-    def new_entry(cls, current_user_id, **columns):
-        new_item = cls(**columns)
+    def get_page(cls, what=None, *, limit=None, offset=0, order_by=None, descending=False,
+                 search=None, search_in=(), **where):
+        """
+        Return the total number of matching rows and the rows of a single page.
+
+        ``order_by`` is a column, or tuple of columns, given like ``what``. Rows are additionally ordered by
+        the id of the table so that pages are stable. If ``search`` is given only rows where one of the
+        ``search_in`` columns contain ``search`` are returned.
+        """
+        query, scalar = cls.get_query(what, **where)
+
+        if search:
+            query = query.where(db.or_(*[_get_table_field(cls, c)[1].contains(search, autoescape=True)
+                                         for c in search_in]))
+
+        total = db.session.execute(db.select(db.func.count()).select_from(query.subquery())).scalar()
 
-        add(new_item)
-        commit()
+        if order_by is not None:
+            if type(order_by) is str:
+                order_by = (order_by,)
+            for o in order_by:
+                column = _get_table_field(cls, o)[1]
+                query = query.order_by(column.desc() if descending else column)
+        query = query.order_by(cls.id.desc() if descending else cls.id)
 
-        Edit.new_created(current_user_id, new_item)
-        commit()
+        result = db.session.execute(query.limit(limit).offset(offset))
+        if scalar:
+            result = result.scalars()
+
+        return total, result.all()
+
+    @classmethod
+    def get_facet(cls, column, counts=False):
+        """
+        Return the sorted distinct values of ``column``, or a dict with the number of rows for each value if
+        ``counts`` is True. The values are cached until an entry that changes ``column`` is written.
+        """
+        facet = facet_cache.get(cls, column)
+        if counts:
+            return dict(facet)
+        else:
+            return [value for value, count in facet]
 
-        return cls.get_one(id = new_item.id)
+    @classmethod
+    def complete(cls, column, prefix, limit=10):
+        """
+        Return up to ``limit`` of the distinct values of ``column`` that start with ``prefix``, ignoring case.
+        """
+        return autocomplete.complete(cls, column, prefix, limit)
 
     @classmethod
     @with_app_context
+    def find_value(cls, column, value):
+        """
+        Return the existing value of ``column`` that is equal to ``value`` ignoring case, or ``None``.
+        """
+        if (found := autocomplete.find(cls, column, value)) is not None:
+            return found
+
+        # The value might have been written since the generation was read, only the database can say it is new
+        column = _get_table_field(cls, column)[1]
+        query = db.select(column).where(db.func.lower(column) == value.lower()).order_by(column != value).limit(1)
+        return db.session.execute(query).scalar()
+
+    @classmethod
+    def new_entry(cls, current_user_id, **columns):
+        with transaction():
+            new_item = cls(**columns)
+
+            add(new_item)
+            flush()  # Gives the item its id
+
+            Edit.new_created(current_user_id, new_item)
+            written('created', new_item)
+
+        return new_item
+
+    @classmethod
     def update_entry(cls, current_user_id, entry_id, **columns):
-        item = cls.get_one(id = entry_id)
-        updated = []
-        for column, new_value in columns.items():
-            old_value = getattr(item, column)
-            if new_value != old_value:
-                setattr(item, column, new_value)
-                Edit.new_edit(current_user_id, item, column, new_value, old_value)
-                updated.append(column)
-            else:
-                continue
-        add(item)
-        commit()
-        return updated
+        with transaction():
+            item = cls.get_one(id = entry_id)
+            changes = {}
+            for column, new_value in columns.items():
+                old_value = getattr(item, column)
+                if new_value != old_value:
+                    setattr(item, column, new_value)
+                    Edit.new_edit(current_user_id, item, column, new_value, old_value)
+                    changes[column] = (old_value, new_value)
+                else:
+                    continue
+            add(item)
+            if changes:
+                flush()
+                written('updated', item, changes)
+
+        return list(changes)
 
 class Attrs(ModelMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -204,15 +440,24 @@ class Attrs(ModelMixin, db.Model):
 
     @classmethod
     def set(cls, key, value):
-        item = cls.get_one(key=key, or_none=True)
-        if item is None:
-            item = cls(key=key, value=str(value))
-        else:
-            item.value = str(value)
+        with transaction():
+            item = cls.get_one(key=key, or_none=True)
+            if item is None:
+                item = cls(key=key, value=str(value))
+            else:
+                item.value = str(value)
 
-        add(item)
-        commit()
-        return cls.get_one('value', key=key)
+            add(item)
+
+        _forget_generations()
+        return item.value
+
+    @classmethod
+    def increment(cls, key):
+        # Done in a single statement so that concurrent increments are not lost. Not committed.
+        db.session.execute(sqlite_insert(cls).values(key=key, value='1').on_conflict_do_update(
+            index_elements=[cls.key], set_={'value': db.cast(db.cast(cls.value, db.Integer) + 1, db.String)}))
+        _forget_generations()
 
 
 class User(UserMixin, ModelMixin, db.Model):
@@ -224,36 +469,86 @@ class User(UserMixin, ModelMixin, db.Model):
     password = db.Column(db.String(100), nullable=False)
 
     @classmethod
-    @with_app_context
     def new_user(cls, name, email, password, verified = False):
         auth_level = auth.VERIFIED if verified else auth.UNVERIFIED
         new_user = cls(name = name,
                        email = email,
-                       password = generate_password_hash(password),
+                       password = auth.hash_password(password),
                        auth_level = auth_level)
 
+        with transaction():
+            add(new_user)
+            flush()
+            database.Edit.new_created(new_user.id, new_user)
+            written('created', new_user)
 
-        add(new_user)
-        commit()
-        database.Edit.new_created(new_user, new_user)
-        commit()
-
-        return cls.get_one(id=new_user.id)
+        return new_user
 
     @classmethod
     def verify_password(cls, user_id, password):
-        user = cls.get_one(id = user_id)
-        return check_password_hash(user.password, password)
+        """
+        Return True if ``password`` is the password of the user.
+
+        If the stored hash was made with outdated parameters it is replaced by a hash made with the
+        current parameters.
+        """
+        pwhash = cls.get_one('password', id = user_id)
+        if not auth.check_password(pwhash, password):
+            return False
+
+        if auth.needs_rehash(pwhash):
+            new_pwhash = auth.hash_password(password)
+            with transaction():
+                # Unless the password was changed in the meantime
+                db.session.execute(db.update(cls).where(cls.id == user_id, cls.password == pwhash)
+                                   .values(password=new_pwhash))
+        return True
 
     @classmethod
     def update_password(cls, user_id, new_password):
-        user = cls.get_one(id=user_id)
+        password = auth.hash_password(new_password)
+
+        with transaction():
+            user = cls.get_one(id=user_id)
+
+            user.password = password
+            add(user)
+            database.Edit.new_edit(user.id, user, 'password', None, None)
+            flush()
+            written('updated', user, {'password': (None, None)})
+
 
-        user.password = generate_password_hash(new_password)
-        add(user)
-        database.Edit.new_edit(user, user, 'password', None, None)
-        commit()
+    def __repr__(self):
+        return f'<User: {self.name}>'
+
+    def __str__(self):
+        return self.name
+
+
+class LoginUser:
+    """
+    The logged in user. Holds only the columns needed by ``auth.required`` and the templates.
+    """
+    __slots__ = ('id', 'name', 'email', 'auth_level')
+
+    is_active = True
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, id, name, email, auth_level):
+        self.id = id
+        self.name = name
+        self.email = email
+        self.auth_level = auth_level
 
+    def get_id(self):
+        return str(self.id)
+
+    def __eq__(self, other):
+        return isinstance(other, (LoginUser, User)) and self.get_id() == other.get_id()
+
+    def __hash__(self):
+        return hash(self.id)
 
     def __repr__(self):
         return f'<User: {self.name}>'
@@ -262,7 +557,58 @@ class User(UserMixin, ModelMixin, db.Model):
         return self.name
 
 
+class UserCache:
+    """
+    Cache of the logged in users so that a request doesn't have to load its user from the database.
+
+    Entries expire after ``ttl`` seconds so changes made by other processes are eventually seen.
+    """
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.users = {}
+        self.invalidated = 0
+
+    def get(self, user_id):
+        entry = self.users.get(user_id, None)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+
+        invalidated = self.invalidated
+        row = User.get_one(('id', 'name', 'email', 'auth_level'), id=user_id, or_none=True)
+        if row is None:
+            return None
+
+        user = LoginUser(*row)
+        with self.lock:
+            # Don't cache a user that might have been loaded before a write
+            if invalidated == self.invalidated:
+                self.users[user_id] = (time.monotonic() + self.ttl, user)
+        return user
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.invalidated += 1
+            self.users.pop(user_id, None)
+
+user_cache = UserCache()
+on_rollback(user_cache.clear)
+
+@on_write
+def update_user_cache(action, item, changes):
+    if type(item) is User:
+        user_cache.invalidate(item.id)
+
+
 class Edit(ModelMixin, db.Model):
+    # For the keyset paginated log, newest first, with and without filters
+    __table_args__ = (db.Index('ix_edit_datetime_id', 'datetime', 'id'),
+                      db.Index('ix_edit_user_id_datetime', 'user_id', 'datetime'),
+                      db.Index('ix_edit_table_item_id_datetime', 'table', 'item_id', 'datetime'))
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.ForeignKey(User.id), nullable=False)
 
@@ -274,6 +620,32 @@ class Edit(ModelMixin, db.Model):
     old_value = db.Column(db.String(150))
     new_value = db.Column(db.String(150))
 
+    @classmethod
+    @with_app_context
+    def get_log(cls, limit=50, before=None, since=None, until=None, **where):
+        """
+        Return a page of at most ``limit`` edits, newest first, and the cursor for the next page.
+
+        ``before`` is the cursor, a ``(datetime, id)`` tuple, of the previous page. The next cursor is
+        ``None`` on the last page.
+        """
+        query, _ = cls.get_query(('id', 'User.name', 'datetime', 'table', 'item_id', 'column',
+                                  'old_value', 'new_value'), **where)
+        if since is not None:
+            query = query.where(cls.datetime >= since)
+        if until is not None:
+            query = query.where(cls.datetime < until)
+        if before is not None:
+            query = query.where(db.tuple_(cls.datetime, cls.id) < before)
+
+        query = query.order_by(cls.datetime.desc(), cls.id.desc()).limit(limit + 1)
+        results = db.session.execute(query).all()
+
+        if len(results) > limit:
+            return results[:limit], (results[limit - 1].datetime, results[limit - 1].id)
+        else:
+            return results, None
+
     @classmethod
     def new_created(cls, user_id, item):
         new_edit = Edit(user_id=user_id,
@@ -307,6 +679,10 @@ class Edit(ModelMixin, db.Model):
         return new_edit
 
 class Citation(ModelMixin, db.Model):
+    # The second index covers the citation listing of get_citations
+    __table_args__ = (db.Index('ix_citation_creator_id', 'creator_id'),
+                      db.Index('ix_citation_year_authors_journal_doi', 'year', 'authors', 'journal', 'doi'))
+
     id = db.Column(db.Integer, primary_key=True)
     creator_id = db.Column(db.ForeignKey(User.id), nullable=False)
 
@@ -317,39 +693,145 @@ class Citation(ModelMixin, db.Model):
     ads = db.Column(db.String(150), nullable=False)
 
     @classmethod
-    def get_citations(cls, sort = True, **where):
-        results = cls.get_all(**where)
+    @with_app_context
+    def get_citations(cls, sort = True, search=None, limit=None, offset=0, **where):
+        """
+        Return a list of the ``(id, label)`` of the citations matching ``where``, ordered by year, authors and
+        journal if ``sort`` is True.
+
+        If ``search`` is given only citations matching it, like ``search_text``, are returned, best match first.
+        ``limit`` and ``offset`` select a single page.
+        """
+        query, scalar = cls.get_query(('id', 'year', 'authors', 'journal', 'doi'), **where)
+
+        if search and (match := fts_query(search)) is not None:
+            query = (query.join(_citation_fts, _citation_fts.c.rowid == cls.id)
+                     .where(_citation_fts.c.citation_fts.op('MATCH')(match))
+                     .order_by(_citation_fts.c.rank))
         if sort:
-            results = sorted(results, key=lambda c: (c.year, c.authors, c.journal))
-
-        citations = []
-        for row in results:
-            authors = row.authors.split(';')
-            if len(authors) > 2:
-                authors = f"{authors[0]}, et al."
-            elif len(authors) == 2:
-                authors = f"{authors[0]} & {authors[1]}"
-            else:
-                authors = authors[0]
-
-            citations.append((row.id, f"{row.year} - {authors} - {row.journal} (doi:{row.doi})"))
+            query = query.order_by(cls.year, cls.authors, cls.journal)
+
+        result = db.session.execute(query.order_by(cls.id).limit(limit).offset(offset))
+        return [(row.id, cls.label(row.year, row.authors, row.journal, row.doi)) for row in result]
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def label(year, authors, journal, doi):
+        authors = authors.split(';')
+        if len(authors) > 2:
+            authors = f"{authors[0]}, et al."
+        elif len(authors) == 2:
+            authors = f"{authors[0]} & {authors[1]}"
+        else:
+            authors = authors[0]
 
-        return citations
+        return f"{year} - {authors} - {journal} (doi:{doi})"
 
     @classmethod
     @with_app_context
-    def delete(cls, user_id, item_id):
-        item = cls.get_one(id=item_id)
+    def search_text(cls, text, *, limit=30, offset=0, order_by=None, descending=False, **where):
+        """
+        Return the total number of citations matching ``text`` and one page of them, best match first.
+
+        Every word in ``text`` must match the start of a word in the authors, journal or doi. Citations are
+        also filtered by their data, e.g. ``sample_type`` and ``element``, like ``Data.get_search``. If there
+        are no words in ``text`` all citations are returned, newest first. ``order_by`` is the name of a
+        column to order by instead.
+        """
+        filtered = any(value not in (None, []) for value in where.values())
+        match = fts_query(text)
+
+        query = db.select(cls)
+        if filtered:
+            query = query.where(cls.id.in_(Data.get_query('citation_id', **where)[0]))
+        if match is not None:
+            query = (query.join(_citation_fts, _citation_fts.c.rowid == cls.id)
+                     .where(_citation_fts.c.citation_fts.op('MATCH')(match))
+                     .order_by(_citation_fts.c.rank))
+        else:
+            query = query.order_by(cls.year.desc())
 
-        data = Data.get_all(citation_id = item_id)
-        for d in data:
-            Data.delete(user_id, d.id)
+        if match is not None and not filtered:
+            # Every row of the index is a citation so the matches can be counted without the join
+            count = db.select(db.func.count()).where(_citation_fts.c.citation_fts.op('MATCH')(match))
+        else:
+            count = db.select(db.func.count()).select_from(query.order_by(None).subquery())
+        total = db.session.execute(count).scalar()
+
+        if order_by is not None:
+            column = _get_table_field(cls, order_by)[1]
+            query = query.order_by(None).order_by(column.desc() if descending else column)
+        results = db.session.execute(query.order_by(cls.id).limit(limit).offset(offset)).scalars().all()
+        return total, results
+
+    def doi_url(self):
+        if self.doi.startswith('https://'):
+            return self.doi
+        else:
+            return f'https://doi.org/{self.doi}'
 
-        delete(item)
-        Edit.new_deleted(user_id, item_id, cls.__name__)
-        commit()
+    def link(self):
+        link = f'<a href="{self.doi_url()}">DOI</a>'
+        if self.ads:
+            link += f'/<a href="{self.ads}">ADS</a>'
+        return link
+
+    @classmethod
+    def delete(cls, user_id, item_id):
+        with transaction():
+            item = cls.get_one(id=item_id)
+
+            data = Data.get_all(citation_id = item_id)
+            for d in data:
+                Data.delete(user_id, d.id)
+
+            delete(item)
+            Edit.new_deleted(user_id, item_id, cls.__name__)
+            flush()
+            written('deleted', item)
+
+# Full text index of the citations. It is an external content FTS5 table, it stores only the index and reads the
+# text from the citation table, that is kept up to date by triggers.
+CITATION_FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS citation_fts USING fts5(
+        authors, journal, doi, content='citation', content_rowid='id', tokenize='unicode61 remove_diacritics 2')""",
+    """CREATE TRIGGER IF NOT EXISTS citation_fts_insert AFTER INSERT ON citation BEGIN
+        INSERT INTO citation_fts(rowid, authors, journal, doi) VALUES (new.id, new.authors, new.journal, new.doi);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS citation_fts_delete AFTER DELETE ON citation BEGIN
+        INSERT INTO citation_fts(citation_fts, rowid, authors, journal, doi)
+        VALUES ('delete', old.id, old.authors, old.journal, old.doi);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS citation_fts_update AFTER UPDATE OF authors, journal, doi ON citation BEGIN
+        INSERT INTO citation_fts(citation_fts, rowid, authors, journal, doi)
+        VALUES ('delete', old.id, old.authors, old.journal, old.doi);
+        INSERT INTO citation_fts(rowid, authors, journal, doi) VALUES (new.id, new.authors, new.journal, new.doi);
+    END""",
+    # Matches are ranked by bm25 with the authors weighted above the journal and the doi
+    "INSERT INTO citation_fts(citation_fts, rank) VALUES ('rank', 'bm25(10.0, 4.0, 1.0)')"]
+
+for statement in CITATION_FTS_DDL:
+    sqlalchemy.event.listen(Citation.__table__, 'after_create', sqlalchemy.DDL(statement))
+sqlalchemy.event.listen(Citation.__table__, 'before_drop', sqlalchemy.DDL('DROP TABLE IF EXISTS citation_fts'))
+
+_citation_fts = sqlalchemy.table('citation_fts', sqlalchemy.column('rowid'), sqlalchemy.column('citation_fts'),
+                                 sqlalchemy.column('rank'))
+
+def fts_query(text):
+    """
+    Return the FTS5 query that matches rows containing words starting with each of the words in ``text``.
+
+    Returns ``None`` if there are no words in ``text``.
+    """
+    terms = [term.replace('"', '""') for term in text.split() if re.search(r'\w', term)]
+    return ' '.join(f'"{term}"*' for term in terms) or None
 
 class Data(ModelMixin, db.Model):
+    # Covering indexes for the search, the data of a citation and the facets
+    __table_args__ = (db.Index('ix_data_element_sample_type_citation_id', 'element', 'sample_type', 'citation_id'),
+                      db.Index('ix_data_sample_type_citation_id', 'sample_type', 'citation_id'),
+                      db.Index('ix_data_citation_id_sample_type_element', 'citation_id', 'sample_type', 'element'))
+
     id = db.Column(db.Integer, primary_key=True)
     citation_id = db.Column(db.ForeignKey(Citation.id), nullable=False)
     creator_id = db.Column(db.ForeignKey(User.id), nullable=False)
@@ -358,76 +840,438 @@ class Data(ModelMixin, db.Model):
     element = db.Column(db.String(2), nullable=False)
 
     @classmethod
-    def get_search(cls, compress=True, headings_only = False, **where):
+    def search_query(cls, compress=True, citation_ids=None, **where):
+        if compress:
+            # All the data of every citation with at least one matching row
+            if citation_ids is None:
+                citation_ids, _ = cls.get_query('citation_id', **where)
+                citation_ids = citation_ids.distinct()
+            else:
+                # A single JSON parameter instead of one bound parameter for each id
+                citation_ids = (db.select(sqlalchemy.column('value', db.Integer))
+                                .select_from(db.func.json_each(json.dumps(citation_ids))))
+            query = (db.select(Citation, cls.sample_type, cls.element)
+                     .join(cls, cls.citation_id == Citation.id)
+                     .where(Citation.id.in_(citation_ids))
+                     .order_by(Citation.id, cls.id))
+        else:
+            query, _ = cls.get_query(('sample_type', 'element', 'Citation'), **where)
+            query = query.order_by(cls.id)
+
+        return query
+
+    @classmethod
+    def iter_search(cls, compress=True, citation_ids=None, yield_per=None, **where):
+        # With yield_per rows are fetched from the cursor in batches instead of all at once
+        rows = db.session.execute(cls.search_query(compress, citation_ids, **where),
+                                  execution_options={'yield_per': yield_per} if yield_per else {})
+
+        if compress:
+            for _, group in itertools.groupby(rows, key=lambda row: row[0].id):
+                group = list(group)
+                yield (group[0][0],
+                       list(dict.fromkeys(row[1] for row in group)),
+                       list(dict.fromkeys(row[2] for row in group)))
+        else:
+            for sample_type, element, citation in rows:
+                yield citation, [sample_type], [element]
+
+    @classmethod
+    @with_app_context
+    def get_search(cls, compress=True, headings_only = False, use_index=True, **where):
         headings = ['Authors', 'Year', 'Journal', 'Sample Type', 'Element', 'Link']
         if headings_only:
             return headings, []
 
-        results = cls.get_all(**where)
-        if results is None:
-            return headings, []
-
-        # get_all('citation_id', distinct=True, **where)
-        #for each citation_id in citation_ids:
-        # get_all(citation_id = citation_id)
+        citation_ids = None
+        if compress and use_index:
+            citation_ids = search_backend.search(**where)
 
         search_results = []
-        citation_ids = []
-        for result in results:
-            if compress:
-                if result.citation_id in citation_ids:
-                    continue
-                else:
-                    citation_ids.append(result.citation_id)
-
-                sampletypes = []
-                elements = []
-                for r in Data.get_all(citation_id=result.citation_id):
-                    if r.sample_type not in sampletypes:
-                        sampletypes.append(r.sample_type)
-                    if r.element not in elements:
-                        elements.append(r.element)
-
-                sampletype = ', '.join(sampletypes)
-                element = ', '.join(elements)
-            else:
-                sampletype = result.sample_type
-                element = result.element
-
-            citation = Citation.get_one(id=result.citation_id)
-            if citation.doi.startswith('https://'):
-                link = f'<a href="{citation.doi}">DOI</a>'
-            else:
-                link = f'<a href="https://doi.org/{citation.doi}">DOI</a>'
-            if citation.ads:
-                link += f'/<a href="{citation.ads}">ADS</a>'
-
+        for citation, sampletypes, elements in cls.iter_search(compress, citation_ids, **where):
             search_results.append((citation.authors,
-                                  citation.year,
-                                  citation.journal,
-                                  sampletype,
-                                  element,
-                                  link))
+                                   citation.year,
+                                   citation.journal,
+                                   ', '.join(sampletypes),
+                                   ', '.join(elements),
+                                   citation.link()))
 
         return headings, search_results
 
     @classmethod
-    @with_app_context
     def delete(cls, user_id, item_id):
-        item = cls.get_one(id=item_id)
-        delete(item)
-        Edit.new_deleted(user_id, item_id, cls.__name__)
-        commit()
-
-
-
-
-
-
-
-
-
-
-
+        with transaction():
+            item = cls.get_one(id=item_id)
+            delete(item)
+            Edit.new_deleted(user_id, item_id, cls.__name__)
+            flush()
+            written('deleted', item)
+
+
+class SearchIndex:
+    """
+    In-memory index of which citations have data for a given sample type and element.
+
+    For every (sample_type, element) pair in the Data table it keeps a bitmap, stored as a python int, where bit ``n``
+    is set if citation ``n`` has at least one such row. A search is then the union of the bitmaps of the selected pairs.
+    The index is built from the database the first time it is used and then kept up to date by the write listener.
+    Writes made by other processes are noticed by the data generation and the index is then built again.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.bitmaps = None
+        # Number of rows for each citation id of every pair. A bit is only cleared when the last row is deleted.
+        self.counts = None
+        # The data generation the index is at
+        self.generation = None
 
+    @with_app_context
+    def build(self):
+        generation = database.generation(data=True)  # Read first, a write made while building makes the index stale
+        counts = {}
+        for citation_id, sample_type, element in db.session.execute(
+                db.select(Data.citation_id, Data.sample_type, Data.element)):
+            pair_counts = counts.setdefault((sample_type, element), {})
+            pair_counts[citation_id] = pair_counts.get(citation_id, 0) + 1
+        bitmaps = {pair: self._bitmap(pair_counts) for pair, pair_counts in counts.items()}
+        self.bitmaps, self.counts, self.generation = bitmaps, counts, generation
+
+    @staticmethod
+    def _bitmap(citation_ids):
+        # Setting the bits of an int one at a time copies the whole int every time, so they are set in a
+        # bytearray that is converted once
+        bits = bytearray(max(citation_ids, default=0) // 8 + 1)
+        for citation_id in citation_ids:
+            bits[citation_id >> 3] |= 1 << (citation_id & 7)
+        return int.from_bytes(bits, 'little')
+
+    @staticmethod
+    def _citation_ids(bitmap):
+        # Linear in the size of the bitmap, clearing the lowest set bit one at a time would copy it for every bit
+        return [i for i, bit in enumerate(bin(bitmap)[:1:-1]) if bit == '1']
+
+    @staticmethod
+    def _add(bitmaps, counts, citation_id, sample_type, element):
+        pair_counts = counts.setdefault((sample_type, element), {})
+        pair_counts[citation_id] = pair_counts.get(citation_id, 0) + 1
+        bitmaps[(sample_type, element)] = bitmaps.get((sample_type, element), 0) | (1 << citation_id)
+
+    @staticmethod
+    def _remove(bitmaps, counts, citation_id, sample_type, element):
+        pair_counts = counts.get((sample_type, element), {})
+        if citation_id not in pair_counts:
+            return
+        pair_counts[citation_id] -= 1
+        if pair_counts[citation_id] == 0:
+            del pair_counts[citation_id]
+            bitmaps[(sample_type, element)] &= ~(1 << citation_id)
+        if not pair_counts:
+            del counts[(sample_type, element)], bitmaps[(sample_type, element)]
+
+    def written(self, action, item, changes):
+        """
+        Apply a write of a citation or data entry made by this process.
+
+        Every such write moves the data generation on by one, so the index then stays at the generation of
+        the database unless another process has written too.
+        """
+        with self.lock:
+            if self.bitmaps is None:
+                return
+            self.generation += 1
+            if type(item) is not Data:
+                return
+
+            if action == 'created':
+                self._add(self.bitmaps, self.counts, item.citation_id, item.sample_type, item.element)
+            elif action == 'deleted':
+                self._remove(self.bitmaps, self.counts, item.citation_id, item.sample_type, item.element)
+            elif action == 'updated':
+                old = {c: getattr(item, c) for c in ('citation_id', 'sample_type', 'element')}
+                old.update({c: old_value for c, (old_value, new_value) in changes.items() if c in old})
+                self._remove(self.bitmaps, self.counts, old['citation_id'], old['sample_type'], old['element'])
+                self._add(self.bitmaps, self.counts, item.citation_id, item.sample_type, item.element)
+
+    def bulk_created(self, entries):
+        """
+        Apply entries created at once by this process, which moves the data generation on by one.
+        """
+        with self.lock:
+            if self.bitmaps is None:
+                return
+            self.generation += 1
+            added = {}
+            for values in entries.get(Data, []):
+                pair, citation_id = (values['sample_type'], values['element']), values['citation_id']
+                pair_counts = self.counts.setdefault(pair, {})
+                pair_counts[citation_id] = pair_counts.get(citation_id, 0) + 1
+                added.setdefault(pair, []).append(citation_id)
+            for pair, citation_ids in added.items():
+                self.bitmaps[pair] = self.bitmaps.get(pair, 0) | self._bitmap(citation_ids)
+
+    def search(self, sample_type=None, element=None, **where):
+        """
+        Return a sorted list of the ids of citations with data matching ``sample_type`` and ``element``.
+
+        Like ``Data.get_query`` an empty list or ``None`` matches everything. Returns ``None`` if the search
+        cannot be answered by the index.
+        """
+        if where or type(sample_type) not in (list, type(None)) or type(element) not in (list, type(None)):
+            return None
+
+        generation = database.generation(data=True)
+        with self.lock:
+            # An older generation was read before a write of this process that the index already includes
+            if self.bitmaps is None or generation > self.generation:
+                self.build()
+
+            bitmap = 0
+            for (pair_sample_type, pair_element), pair_bitmap in self.bitmaps.items():
+                if (not sample_type or pair_sample_type in sample_type) and (not element or pair_element in element):
+                    bitmap |= pair_bitmap
+
+        return self._citation_ids(bitmap)
+
+@on_write
+def increment_generation(action, item, changes):
+    Attrs.increment('generation')
+    if type(item).__name__ in DATA_TABLES:
+        Attrs.increment('data_generation')
+
+@on_bulk_create
+def increment_generation_once(entries):
+    Attrs.increment('generation')
+    if any(table.__name__ in DATA_TABLES for table in entries):
+        Attrs.increment('data_generation')
+
+search_index = SearchIndex()
+on_rollback(search_index.clear)
+
+# Used by Data.get_search. Replaced by the snapshot if SEARCH_BACKEND is 'snapshot'.
+search_backend = search_index
+
+class FacetCache:
+    """
+    Cache of the distinct values of a column and the number of rows with each value.
+
+    The facets are kept at the data generation they were loaded at. A write made by this process only drops
+    the facets of the columns it changed and moves the others on to the next generation, like
+    ``SearchIndex.written``. All the facets are loaded again once the generation shows that another process
+    has written.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.facets = {}
+        self.invalidated = 0
+        # The data generation the facets are at
+        self.generation = None
 
+    @with_app_context
+    def _load(self, table, column):
+        column = _get_table_field(table, column)[1]
+        query = db.select(column, db.func.count()).group_by(column).order_by(column)
+        return tuple((value, count) for value, count in db.session.execute(query))
+
+    def get(self, table, column):
+        key = (table.__name__, column)
+        generation = database.generation(data=True)
+        with self.lock:
+            # An older generation was read before a write of this process that the facets already include
+            if self.generation is None or generation > self.generation:
+                self.facets, self.generation = {}, generation
+                self.invalidated += 1
+            if (facet := self.facets.get(key, None)) is not None:
+                return facet
+            invalidated = self.invalidated
+
+        facet = self._load(table, column)
+        with self.lock:
+            # Don't cache values that might have been loaded before a write
+            if invalidated == self.invalidated:
+                self.facets[key] = facet
+        return facet
+
+    def written(self, action, item, changes):
+        """
+        Apply a write made by this process. Only the facets of the columns that were changed are dropped.
+        """
+        with self.lock:
+            if type(item).__name__ in DATA_TABLES and self.generation is not None:
+                self.generation += 1
+            self._invalidate(type(item), changes.keys() if action == 'updated' else None)
+
+    def bulk_created(self, entries):
+        """
+        Apply entries created at once by this process.
+        """
+        with self.lock:
+            if any(table.__name__ in DATA_TABLES for table in entries) and self.generation is not None:
+                self.generation += 1
+            for table in entries:
+                self._invalidate(table)
+
+    def _invalidate(self, table, columns=None):
+        # Must be called with the lock held
+        self.invalidated += 1
+        for key in list(self.facets):
+            if key[0] == table.__name__ and (columns is None or key[1] in columns):
+                del self.facets[key]
+
+facet_cache = FacetCache()
+on_rollback(facet_cache.clear)
+
+@on_write
+def update_facet_cache(action, item, changes):
+    facet_cache.written(action, item, changes)
+
+class Autocomplete:
+    """
+    In-memory prefix index of the distinct values of columns, for autocompletion and case insensitive lookups.
+
+    For each column it keeps a sorted list of ``(value.casefold(), value)`` so that completing a prefix or finding
+    a value is a binary search. It is built from the facet of the column the first time it is used and then kept
+    up to date by the write listener. Like the search index it is built again when the data generation shows
+    that another process has written.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.entries = {}
+        # Number of rows with each value. A value is only removed when its last row is deleted.
+        self.counts = {}
+        # The data generation the entries are at
+        self.generation = None
+
+    def _lookup(self, table, column, func):
+        # Return func(entries) of the column, called with the lock held. The facet of a column that isn't loaded
+        # yet is read without the lock, since that may query the database.
+        key = (table.__name__, column)
+        generation = database.generation(data=True)
+        with self.lock:
+            # An older generation was read before a write of this process that the entries already include
+            if self.generation is None or generation > self.generation:
+                self.entries, self.counts, self.generation = {}, {}, generation
+            if key in self.entries:
+                return func(self.entries[key])
+            loaded_at = self.generation
+
+        facet = facet_cache.get(table, column)
+        entries = sorted((value.casefold(), value) for value, count in facet)
+        with self.lock:
+            # Not kept if a write was applied in the meantime, the facet might not include it
+            if self.generation == loaded_at and key not in self.entries:
+                self.counts[key], self.entries[key] = dict(facet), entries
+            return func(entries)
+
+    def complete(self, table, column, prefix, limit=10):
+        """
+        Return up to ``limit`` values of ``column`` that start with ``prefix``, ignoring case, in order.
+        """
+        prefix = prefix.casefold()
+        def complete(entries):
+            start = bisect.bisect_left(entries, (prefix,))
+            values = []
+            for key, value in entries[start:start + limit]:
+                if not key.startswith(prefix):
+                    break
+                values.append(value)
+            return values
+        return self._lookup(table, column, complete)
+
+    def find(self, table, column, value):
+        """
+        Return the value of ``column`` that is equal to ``value`` ignoring case, or ``None`` if there is none.
+
+        If there are several such values ``value`` itself is preferred.
+        """
+        key = value.casefold()
+        def find(entries):
+            found = None
+            i = bisect.bisect_left(entries, (key,))
+            while i < len(entries) and entries[i][0] == key:
+                if entries[i][1] == value:
+                    return value
+                found = found or entries[i][1]
+                i += 1
+            return found
+        return self._lookup(table, column, find)
+
+    def written(self, action, item, changes):
+        """
+        Apply a write of a citation or data entry made by this process, see ``SearchIndex.written``.
+        """
+        with self.lock:
+            if self.generation is None:
+                return
+            self.generation += 1
+
+            for name, column in self.entries:
+                if name != type(item).__name__:
+                    continue
+                if action == 'created':
+                    self._add((name, column), getattr(item, column))
+                elif action == 'deleted':
+                    self._remove((name, column), getattr(item, column))
+                elif column in changes:
+                    old_value, new_value = changes[column]
+                    self._remove((name, column), old_value)
+                    self._add((name, column), new_value)
+
+    def bulk_created(self, entries):
+        """
+        Apply entries created at once by this process, which moves the data generation on by one.
+        """
+        with self.lock:
+            if self.generation is None:
+                return
+            self.generation += 1
+
+            for (name, column) in self.entries:
+                for table, items in entries.items():
+                    if table.__name__ == name:
+                        for values in items:
+                            self._add((name, column), values[column])
+
+    def _add(self, key, value):
+        counts = self.counts[key]
+        if value not in counts:
+            bisect.insort(self.entries[key], (value.casefold(), value))
+        counts[value] = counts.get(value, 0) + 1
+
+    def _remove(self, key, value):
+        counts = self.counts[key]
+        if value not in counts:
+            return
+        counts[value] -= 1
+        if counts[value] == 0:
+            del counts[value]
+            entries = self.entries[key]
+            del entries[bisect.bisect_left(entries, (value.casefold(), value))]
+
+autocomplete = Autocomplete()
+on_rollback(autocomplete.clear)
+
+@on_write
+def update_autocomplete(action, item, changes):
+    if type(item).__name__ in DATA_TABLES:
+        autocomplete.written(action, item, changes)
+
+@on_write
+def update_search_index(action, item, changes):
+    if type(item).__name__ in DATA_TABLES:
+        search_index.written(action, item, changes)
+
+@on_bulk_create
+def bulk_update_caches(entries):
+    if any(table.__name__ in DATA_TABLES for table in entries):
+        autocomplete.bulk_created(entries)
+        search_index.bulk_created(entries)
+    facet_cache.bulk_created(entries)
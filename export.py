@@ -0,0 +1,63 @@
+import csv, io, json, re
+
+__all__ = ['FORMATS', 'HEADINGS', 'csv_lines', 'ndjson_lines', 'bibtex_entries']
+
+HEADINGS = ['citation_id', 'authors', 'year', 'journal', 'doi', 'ads', 'sample_type', 'element']
+
+# format: (mimetype, file extension, function)
+FORMATS = {}
+
+def export_format(name, mimetype, extension):
+    def register(func):
+        FORMATS[name] = (mimetype, extension, func)
+        return func
+    return register
+
+def _row(citation, sample_types, elements):
+    return [citation.id, citation.authors, citation.year, citation.journal,
+            citation.doi, citation.ads, ', '.join(sample_types), ', '.join(elements)]
+
+@export_format('csv', 'text/csv', 'csv')
+def csv_lines(results):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def line(row):
+        writer.writerow(row)
+        value = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return value
+
+    yield line(HEADINGS)
+    for result in results:
+        yield line(_row(*result))
+
+@export_format('json', 'application/x-ndjson', 'jsonl')
+def ndjson_lines(results):
+    for result in results:
+        yield json.dumps(dict(zip(HEADINGS, _row(*result)))) + '\n'
+
+@export_format('bibtex', 'application/x-bibtex', 'bib')
+def bibtex_entries(results):
+    def value(text):
+        return str(text).replace('{', '').replace('}', '')
+
+    for citation, sample_types, elements in results:
+        authors = citation.authors.split(';')
+        surname = re.sub(r'\W', '', authors[0].split(',')[0])
+
+        fields = dict(author=' and '.join(a.strip() for a in authors),
+                      year=citation.year,
+                      journal=citation.journal)
+        if citation.doi.startswith('https://'):
+            fields['url'] = citation.doi
+        else:
+            fields['doi'] = citation.doi
+        if citation.ads:
+            fields['adsurl'] = citation.ads
+        fields['sample_type'] = ', '.join(sample_types)
+        fields['element'] = ', '.join(elements)
+
+        entry = ',\n'.join(f'  {k} = {{{value(v)}}}' for k, v in fields.items())
+        yield f'@article{{{surname}{citation.year}_{citation.id},\n{entry}\n}}\n\n'
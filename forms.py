@@ -1,13 +1,15 @@
 from wtforms import SelectField, StringField, PasswordField, SubmitField, IntegerField
-from wtforms import SelectMultipleField, EmailField, BooleanField
+from wtforms import SelectMultipleField, EmailField, BooleanField, DateField
 from wtforms import validators, ValidationError
+from wtforms.utils import unset_value
 from flask_wtf import FlaskForm
 from flask_wtf.recaptcha import RecaptchaField
+from flask_wtf.file import FileField, FileRequired
 
 
 __all__ = ['SelectField', 'StringField', 'PasswordField', 'SubmitField', 'IntegerField',
-           'SelectMultipleField', 'EmailField', 'RecaptchaField', 'BooleanField',
-           'validators', 'ValidationError', 'FlaskForm',
+           'SelectMultipleField', 'EmailField', 'RecaptchaField', 'BooleanField', 'DateField',
+           'validators', 'ValidationError', 'FlaskForm', 'FileField', 'FileRequired',
            'IntSelectField', 'NewEntrySelectField']
 
 enumerate_ = enumerate
@@ -36,21 +38,46 @@ class IntSelectField(SelectField):
 
 
 class NewEntrySelectField(SelectField):
-    def __init__(self, label, new_entry_field, choices, **kwargs):
+    """
+    Select field where the first choice means that a new entry is typed into the ``new_entry_field``.
+
+    If ``lookup`` is given, a function returning the existing entry equal to a value ignoring case or ``None``,
+    it is used to check the selected and the new entry instead of ``choices``. The choices then only need the
+    first choice, the rest can be filled in by the browser, and the default and selected entries are added.
+    """
+    def __init__(self, label, new_entry_field, choices, lookup=None, **kwargs):
         validators = kwargs.pop('validators', []) + [self._validator_]
         if type(default:=kwargs.get('default', None)) == int:
             kwargs['default'] = choices[default] if default < len(choices) else None
         self.new_entry_field = new_entry_field
+        self.lookup = lookup
         self.choice = None
 
         super().__init__(label, choices=choices, validators=validators, **kwargs)
 
+    def process(self, formdata, data=unset_value, extra_filters=None):
+        super().process(formdata, data, extra_filters)
+        if self.lookup is not None and self.data and self.data not in self.choices:
+            self.choices = list(self.choices) + [self.data]
+
+    def pre_validate(self, form):
+        if self.lookup is None:
+            super().pre_validate(form)
+        elif self.data != self.choices[0] and self.lookup(self.data) != self.data:
+            raise ValidationError(self.gettext('Not a valid choice.'))
+
+    def exists(self, entry):
+        if self.lookup is not None:
+            return self.lookup(entry) is not None
+        else:
+            return entry.casefold() in {c.casefold() for c in self.choices}
+
     def _validator_(self, form, field):
         new_entry_field = getattr(form, self.new_entry_field)
         if field.data == field.choices[0]:
             if new_entry_field.data == '':
                 raise ValidationError(f'The new entry field is empty')
-            elif new_entry_field.data.lower() in [c.lower() for c in self.choices]:
+            elif self.exists(new_entry_field.data):
                 raise ValidationError("The new entry already exits in this list")
             self.choice = new_entry_field.data
         elif new_entry_field.data != '':
@@ -0,0 +1,239 @@
+import csv, io, re, datetime
+import click
+
+import database
+from database import db
+
+__all__ = ['FORMATS', 'parse_doi', 'parse_csv', 'parse_bibtex', 'validate', 'import_rows', 'import_file']
+
+ADS_PREFIX = 'https://ui.adsabs.harvard.edu/'
+
+def init(app):
+    @app.cli.command('import-data')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--user', 'email', required=True, help='Email of the user the data is added by.')
+    @click.option('--format', 'format', type=click.Choice(list(FORMATS)), default=None,
+                  help='File format. Guessed from the file extension if not given.')
+    def import_data_command(path, email, format):
+        """Import citations and data from a CSV or BibTeX file."""
+        user = database.User.get_one(email=email, or_none=True)
+        if user is None:
+            raise click.BadParameter(f'No user with the email "{email}"')
+
+        with open(path, encoding='utf-8') as file:
+            result = import_file(user.id, file.read(), format or path.rsplit('.', 1)[-1].lower())
+
+        for line, error in result.errors:
+            click.echo(f'Line {line}: {error}', err=True)
+        click.echo(f'Added {result.citations} citations and {result.data} data entries')
+
+def parse_doi(text):
+    if m := re.search(r".*(10[.][\d.]*[/].*)$", text):
+        return m.group(1)
+    else:
+        return None
+
+#############
+### Parse ###
+#############
+
+def parse_csv(text):
+    """
+    Return a list of ``(line, row)`` for a CSV file with the columns ``authors``, ``year``, ``journal``,
+    ``doi``, ``ads``, ``sample_type`` and ``element``. This is the format of the search export with ``compress=false``.
+    """
+    reader = csv.DictReader(io.StringIO(text))
+    return [(reader.line_num, row) for row in reader]
+
+def parse_bibtex(text):
+    """
+    Return a list of ``(line, row)`` for the entries in a BibTeX file. The data is taken from the non-standard
+    ``sample_type`` and ``element`` fields of each entry. This is the format of the search export.
+    """
+    rows = []
+    entry_start = re.compile(r'@\w+\s*\{\s*[^,\s]*\s*,')
+    field_start = re.compile(r'\s*(\w+)\s*=\s*')
+    field_end = re.compile(r'\s*,?')
+
+    def read_value(pos):
+        # Returns the value starting at pos and the position after it
+        if text[pos] == '{':
+            depth, end = 0, pos
+            while end < len(text):
+                depth += {'{': 1, '}': -1}.get(text[end], 0)
+                if depth == 0:
+                    break
+                end += 1
+            return text[pos + 1:end], end + 1
+        elif text[pos] == '"':
+            end = text.index('"', pos + 1)
+            return text[pos + 1:end], end + 1
+        else:
+            m = re.match(r'[^,}\s]*', text[pos:])
+            return m.group(0), pos + m.end()
+
+    pos = 0
+    while m := entry_start.search(text, pos):
+        line = text.count('\n', 0, m.start()) + 1
+        pos, fields = m.end(), {}
+        while f := field_start.match(text, pos):
+            try:
+                value, pos = read_value(f.end())
+            except (IndexError, ValueError):
+                break
+            fields[f.group(1).lower()] = ' '.join(value.replace('{', '').replace('}', '').split())
+            pos = field_end.match(text, pos).end()
+
+        rows.append((line, dict(authors='; '.join(a.strip() for a in fields.get('author', '').split(' and ')),
+                                year=fields.get('year', ''),
+                                journal=fields.get('journal', ''),
+                                doi=fields.get('doi', '') or fields.get('url', ''),
+                                ads=fields.get('adsurl', ''),
+                                sample_type=fields.get('sample_type', ''),
+                                element=fields.get('element', ''))))
+        pos = text.find('}', pos) + 1 or len(text)
+
+    return rows
+
+FORMATS = {'csv': parse_csv, 'bib': parse_bibtex, 'bibtex': parse_bibtex}
+
+################
+### Validate ###
+################
+
+def validate_row(row):
+    """
+    Return the cleaned citation and data of a row. Raises ``ValueError`` with the error message if the row is invalid.
+    """
+    row = {k: (v or '').strip() for k, v in row.items() if k is not None}
+
+    authors = row.get('authors', '')
+    if not 1 <= len(authors) <= 150:
+        raise ValueError('Authors must be between 1 and 150 characters')
+
+    try:
+        year = int(row.get('year', ''))
+    except ValueError:
+        raise ValueError(f'Invalid year ("{row.get("year", "")}")')
+    if not 1850 <= year <= 2050:
+        raise ValueError(f'Year must be between 1850 and 2050')
+
+    journal = row.get('journal', '')
+    if not 1 <= len(journal) <= 150:
+        raise ValueError('Journal must be between 1 and 150 characters')
+
+    doi = row.get('doi', '')
+    if not doi.startswith('https://') or doi.startswith('https://doi.org/'):
+        doi = parse_doi(doi)
+        if doi is None:
+            raise ValueError(f'Invalid DOI ("{row.get("doi", "")}")')
+    if len(doi) > 150:
+        raise ValueError('DOI must be at most 150 characters')
+
+    ads = row.get('ads', '')
+    if ads != '' and not ads.startswith(ADS_PREFIX):
+        raise ValueError(f'Invalid ADS ("{ads}")')
+
+    sample_type = row.get('sample_type', '')
+    if not 1 <= len(sample_type) <= 150:
+        raise ValueError('Sample type must be between 1 and 150 characters')
+
+    elements = [e.strip().capitalize() for e in row.get('element', '').split(',')]
+    for element in elements:
+        if not 1 <= len(element) <= 2:
+            raise ValueError(f'Invalid element symbol ("{element}")')
+
+    citation = dict(authors=authors, year=year, journal=journal, doi=doi, ads=ads)
+    return citation, [dict(sample_type=sample_type, element=element) for element in dict.fromkeys(elements)]
+
+def validate(rows):
+    """
+    Validate a list of ``(line, row)``.
+
+    Returns a dict mapping the doi of each citation to its citation, a list of ``(doi, data)`` and a
+    list of ``(line, error)`` for the invalid rows. Rows with the same doi are for the same citation.
+    """
+    citations, data, errors = {}, [], []
+    for line, row in rows:
+        try:
+            citation, row_data = validate_row(row)
+            if citations.get(citation['doi'], citation) != citation:
+                raise ValueError(f'The citation does not match an earlier row with the same doi')
+        except ValueError as err:
+            errors.append((line, str(err)))
+        else:
+            citations.setdefault(citation['doi'], citation)
+            data += [(citation['doi'], d) for d in row_data]
+
+    return citations, data, errors
+
+##############
+### Import ###
+##############
+
+def _normalizer(table, column):
+    # Returns a function that gives the existing spelling of a value that only differs by case, or the
+    # first spelling seen in the import for new values
+    known = {}
+    def normalize(value):
+        key = value.casefold()
+        if key not in known:
+            known[key] = table.find_value(column, value) or value
+        return known[key]
+    return normalize
+
+def _insert(table, rows):
+    # Inserts the rows with a single executemany and sets their ids. The transaction holds the write lock from
+    # the first insert so the rows are the last ones in the table, in order.
+    db.session.execute(db.insert(table), rows)
+    ids = db.session.scalars(db.select(table.id).order_by(table.id.desc()).limit(len(rows))).all()
+    for values, id in zip(rows, reversed(ids)):
+        values['id'] = id
+
+def import_rows(user_id, rows):
+    """
+    Add the citations and data of a list of ``(line, row)`` to the database in a single transaction.
+
+    Citations whose doi already exist in the database are not added again, instead the data is added to the
+    existing citation. Journals and sample types that only differ by case from existing ones are changed to
+    the existing spelling. Invalid rows are skipped. Returns the number of citations and data entries added
+    and the list of ``(line, error)`` for the skipped rows.
+    """
+    citations, data, errors = validate(rows)
+    now = datetime.datetime.now()
+
+    journal = _normalizer(database.Citation, 'journal')
+    sample_type = _normalizer(database.Data, 'sample_type')
+
+    with database.transaction():
+        citation_ids = dict(db.session.execute(db.select(database.Citation.doi, database.Citation.id)
+                                               .where(database.Citation.doi.in_(list(citations)))).all())
+
+        new_citations = [dict(c, creator_id=user_id, journal=journal(c['journal']))
+                         for doi, c in citations.items() if doi not in citation_ids]
+        new_data = [dict(d, creator_id=user_id, sample_type=sample_type(d['sample_type'])) for doi, d in data]
+
+        if new_citations:
+            _insert(database.Citation, new_citations)
+            for values in new_citations:
+                citation_ids[values['doi']] = values['id']
+
+        for values, (doi, d) in zip(new_data, data):
+            values['citation_id'] = citation_ids[doi]
+        if new_data:
+            _insert(database.Data, new_data)
+
+        edits = [dict(user_id=user_id, datetime=now, table=table.__name__, item_id=values['id'], column='CREATED')
+                 for table, items in [(database.Citation, new_citations), (database.Data, new_data)]
+                 for values in items]
+        if edits:
+            db.session.execute(db.insert(database.Edit), edits)
+            database.bulk_created({table: items for table, items in [(database.Citation, new_citations),
+                                                                    (database.Data, new_data)] if items})
+
+    return database.NamedDict(citations=len(new_citations), data=len(new_data), errors=errors)
+
+def import_file(user_id, text, format):
+    if format not in FORMATS:
+        raise ValueError(f'Unknown format "{format}"')
+    return import_rows(user_id, FORMATS[format](text))
@@ -0,0 +1,93 @@
+import os
+import click
+
+import database
+from database import db
+
+__all__ = ['MIGRATIONS', 'migration', 'get_version', 'upgrade']
+
+# (version, description, function) sorted by version. Each function is called with a connection and makes the
+# changes for that version. The version of a database is stored in its user_version.
+MIGRATIONS = []
+
+def migration(version, description):
+    def register(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return register
+
+def init(app):
+    @app.cli.command('db-upgrade')
+    def upgrade_command():
+        """Create missing tables and apply all new migrations to the database."""
+        for version, description in upgrade(create=True):
+            click.echo(f'Applied migration {version}: {description}')
+        click.echo(f'The database is at version {get_version()}')
+
+    # Databases are only created with the command above, not when the app starts
+    path = app.config['SQLALCHEMY_DATABASE_URI'].removeprefix('sqlite:///')
+    if app.config.get('MIGRATE_ON_STARTUP', False) and os.path.exists(path):
+        upgrade()
+
+@database.with_app_context
+def get_version():
+    with db.engine.connect() as connection:
+        return connection.exec_driver_sql('PRAGMA user_version').scalar()
+
+@database.with_app_context
+def upgrade(create=False):
+    """
+    Apply all migrations newer than the version of the database in a single transaction.
+
+    If ``create`` is True tables that are missing are first created from the models. Returns a list of the
+    ``(version, description)`` of the applied migrations.
+
+    pysqlite only begins a transaction before INSERT, UPDATE and DELETE statements, so the transaction is begun
+    explicitly with BEGIN IMMEDIATE. That also takes the write lock before the version is read, so when several
+    workers start at the same time the first applies the migrations and the others wait for it and then find
+    the database already upgraded.
+    """
+    applied = []
+    with db.engine.begin() as connection:
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+        if create:
+            db.metadata.create_all(connection)
+
+        current = connection.exec_driver_sql('PRAGMA user_version').scalar()
+        for version, description, func in MIGRATIONS:
+            if version > current:
+                func(connection)
+                connection.exec_driver_sql(f'PRAGMA user_version = {int(version)}')
+                applied.append((version, description))
+
+    return applied
+
+##################
+### Migrations ###
+##################
+
+@migration(1, 'Add indexes for the search, edit history and edit log')
+def add_indexes(connection):
+    for statement in ['CREATE INDEX IF NOT EXISTS ix_data_element_sample_type_citation_id '
+                      'ON data (element, sample_type, citation_id)',
+                      'CREATE INDEX IF NOT EXISTS ix_data_sample_type_citation_id ON data (sample_type, citation_id)',
+                      'CREATE INDEX IF NOT EXISTS ix_data_citation_id_sample_type_element '
+                      'ON data (citation_id, sample_type, element)',
+                      'CREATE INDEX IF NOT EXISTS ix_citation_creator_id ON citation (creator_id)',
+                      'CREATE INDEX IF NOT EXISTS ix_edit_datetime_id ON edit (datetime, id)',
+                      'CREATE INDEX IF NOT EXISTS ix_edit_user_id_datetime ON edit (user_id, datetime)',
+                      'CREATE INDEX IF NOT EXISTS ix_edit_table_item_id_datetime ON edit ("table", item_id, datetime)',
+                      'ANALYZE']:
+        connection.exec_driver_sql(statement)
+
+@migration(2, 'Add the full text index of the citations')
+def add_citation_fts(connection):
+    for statement in database.CITATION_FTS_DDL:
+        connection.exec_driver_sql(statement)
+    connection.exec_driver_sql("INSERT INTO citation_fts(citation_fts) VALUES ('rebuild')")
+
+@migration(3, 'Add an index for the citation listing')
+def add_citation_listing_index(connection):
+    connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_citation_year_authors_journal_doi '
+                               'ON citation (year, authors, journal, doi)')
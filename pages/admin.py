@@ -1,8 +1,8 @@
 import flask
 from flask import Blueprint
-import secrets
+import secrets, datetime, os
 
-import database, render, forms, auth
+import database, render, forms, auth, backup
 
 admin = Blueprint('admin', __name__)
 
@@ -23,6 +23,24 @@ def change_level_form(user_choices):
     return Form()
 
 
+def edit_log_form(users):
+    class Form(forms.FlaskForm):
+        # Filtering the log only reads data so it is done with GET requests without a csrf token
+        class Meta:
+            csrf = False
+
+        user = forms.SelectField('User', choices=[(0, 'All users')] + [(user.id, user.name) for user in users],
+                                 default=0, coerce=int)
+        table_ = forms.SelectField('Table', choices=[('', 'All tables'), ('Citation', 'Citation'), ('Data', 'Data'), ('User', 'User')], default='')
+        item_id = forms.IntegerField('Item Id', validators=[forms.validators.Optional()])
+        since = forms.DateField('From', validators=[forms.validators.Optional()])
+        until = forms.DateField('To', validators=[forms.validators.Optional()])
+        button = forms.SubmitField('Filter')
+    return Form(formdata=flask.request.args or None)
+
+class BackupForm(forms.FlaskForm):
+    button = forms.SubmitField('Back up now')
+
 ##############
 ### Routes ###
 ##############
@@ -30,10 +48,31 @@ def change_level_form(user_choices):
 @admin.route('/all_edits')
 @auth.moderator_required
 def all_edits():
-    results = database.Edit.get_all(('User.name', 'datetime', 'table', 'item_id', 'column',
-                                     'old_value', 'new_value'))
+    form = edit_log_form(database.User.get_all(('id', 'name')))
+    args = flask.request.args
+
+    where = {}
+    if args and form.validate():
+        where = dict(user_id=form.user.data or None,
+                     table=form.table_.data or None,
+                     item_id=form.item_id.data,
+                     since=form.since.data,
+                     until=form.until.data + datetime.timedelta(days=1) if form.until.data else None)
+
+    try:
+        before = args.get('before', None)
+        if before is not None:
+            timestamp, item_id = before.rsplit('_', 1)
+            before = (datetime.datetime.fromisoformat(timestamp), int(item_id))
+    except ValueError:  # Also raised when there is no _ to unpack
+        flask.abort(400)
+
+    results, next_before = database.Edit.get_log(50, before, **where)
+
     headings = ('User Name', 'Timestamp', 'Table', 'Item Id', 'Column', 'Old Value', 'New Value')
-    return render.table('table.html', headings, reversed(results))
+    return render.table('form_table.html', headings, [row[1:] for row in results], pagination=False,
+                        form=form, form_method='get',
+                        markdown=markdown_all_edits(next_before, before is not None))
 
 @admin.route('/signup_link')
 @auth.moderator_required
@@ -68,6 +107,20 @@ def change_role():
             render.flash_success('User role changed')
     return render.template('form.html', form=form, markdown=markdown_change_role())
 
+@admin.route('/backups', methods=['GET', 'POST'])
+@auth.admin_required
+def backups():
+    form = BackupForm()
+    if form.validate_on_submit():
+        path = backup.backup()
+        render.flash_success(f'Backup {os.path.basename(path)} created')
+        return render.redirect('admin.backups')
+
+    results = [(os.path.basename(path), f'{created:%Y-%m-%d %H:%M:%S}', f'{os.path.getsize(path) / 1e6:.1f} MB')
+               for path, created in backup.list_backups()]
+    return render.table('form_table.html', ('Backup', 'Created (UTC)', 'Size'), results, pagination=False,
+                        form=form, markdown=markdown_backups())
+
 ############
 ### Text ###
 ############
@@ -82,6 +135,25 @@ def markdown_signup_link():
     To create a new signup link click [here]({flask.url_for("admin.update_signup_link")}).
     """)
 
+def markdown_all_edits(next_before, paged):
+    args = flask.request.args.to_dict()
+    args.pop('before', None)
+
+    links = []
+    if paged:
+        links.append(f'[Newest edits]({flask.url_for("admin.all_edits", **args)})')
+    if next_before is not None:
+        before = f'{next_before[0].isoformat()}_{next_before[1]}'
+        links.append(f'[Older edits]({flask.url_for("admin.all_edits", before=before, **args)})')
+
+    return dict(before_table="""
+        ### Edits
+        """,
+        after_table=f"""
+        {' | '.join(links)}
+        """)
+
+@render.static_markdown
 def markdown_change_role():
     return dict(
         before_form="""
@@ -104,4 +176,14 @@ def markdown_change_role():
         
         ---
         """
-    )
\ No newline at end of file
+    )
+
+@render.static_markdown
+def markdown_backups():
+    return dict(
+        before_form="""
+        ### Backups
+        Backups of the database are made while the site is running and old backups are removed automatically.
+        To restore a backup run ``flask backup restore PATH`` on the server.
+        """
+    )
@@ -1,20 +1,22 @@
-import re
-
+import functools
+import flask
 from flask import Blueprint
 
-import render, forms, auth, database
+import render, forms, auth, database, importer
+from importer import parse_doi
 
 dm = Blueprint('dm', __name__)
 
-def parse_doi(text):
-    if m := re.search(".*(10[.][\d.]*[/].*)$", text):
-        return m.group(1)
-    else:
-        return None
-
 #############
 ### Forms ###
 #############
+def complete_render_kw(column, placeholder):
+    # Attributes for a NewEntrySelectField that is filled in with the completions of column. The first
+    # choice, for a new entry, is kept.
+    return {'data-typeahead': render.url_for('dm.complete', column=column),
+            'data-typeahead-keep': 1,
+            'data-placeholder': placeholder}
+
 def add_citation_form(button_text = 'Submit',
                       allowed_doi = '', **defaults):
     def doi_validator(form, field):
@@ -38,12 +40,15 @@ def add_citation_form(button_text = 'Submit',
         if ads != '' and not ads.startswith('https://ui.adsabs.harvard.edu/'):
             raise forms.ValidationError('Invalid ADS')
 
-    journal_list = ["<New Journal>"] + database.Citation.get_all('journal', distinct=True)
+    # The journals are filled in by the typeahead
+    journal_list = ["<New Journal>"]
 
     class Form(forms.FlaskForm):
         authors = forms.StringField('Authors:', default=defaults.get('authors', None), validators=[forms.validators.Length(1, 150)])
         year = forms.IntegerField('Year:', default=defaults.get('year', None), validators=[forms.validators.NumberRange(1850, 2050)])
-        journal = forms.NewEntrySelectField('Journal:', 'journal_new', journal_list, default=defaults.get('journal', 0), validators=[forms.validators.DataRequired()])
+        journal = forms.NewEntrySelectField('Journal:', 'journal_new', journal_list, default=defaults.get('journal', 0), validators=[forms.validators.DataRequired()],
+                                            lookup=functools.partial(database.Citation.find_value, 'journal'),
+                                            render_kw=complete_render_kw('journal', 'Search journals'))
         journal_new = forms.StringField('New Journal:', default = '', validators=[forms.validators.Length(0, 150)])
         doi = forms.StringField('DOI:', default=defaults.get('doi', None), validators=[forms.validators.DataRequired(), forms.validators.Length(1, 150), doi_validator])
         nodoi = forms.BooleanField('No DOI, use URL instead', default=defaults.get('nodoi', False))
@@ -62,7 +67,8 @@ def add_data_form(citation_choices = [],
                   multi_element = False,
                   **defaults):
 
-    sample_type_choices = ['<New Sample Type>'] + database.Data.get_all('sample_type', distinct=True)
+    # The sample types are filled in by the typeahead
+    sample_type_choices = ['<New Sample Type>']
 
     def element_validator(form, field):
         if multi_element:
@@ -80,10 +86,14 @@ def add_data_form(citation_choices = [],
                                   choices = citation_choices,
                                   default=defaults.get('citation', None),
                                   enumerate=False,
-                                  validators=[forms.validators.DataRequired()])
+                                  validators=[forms.validators.DataRequired()],
+                                  render_kw={'data-typeahead': render.url_for('dm.citations'),
+                                             'data-placeholder': 'Search authors, journal or DOI'})
         sample_type = forms.NewEntrySelectField('Sample Type:', 'sample_type_new', sample_type_choices,
                                                default=defaults.get('sample_type', 0),
-                                               validators=[forms.validators.DataRequired()])
+                                               validators=[forms.validators.DataRequired()],
+                                               lookup=functools.partial(database.Data.find_value, 'sample_type'),
+                                               render_kw=complete_render_kw('sample_type', 'Search sample types'))
         sample_type_new = forms.StringField('New Sample Type:', default = '',
                                              validators=[forms.validators.Length(0, 150)])
         element = forms.StringField('Element:',
@@ -93,6 +103,11 @@ def add_data_form(citation_choices = [],
 
     return Form()
 
+class ImportForm(forms.FlaskForm):
+    file = forms.FileField('File:', validators=[forms.FileRequired()])
+    format = forms.SelectField('Format:', choices=[('csv', 'CSV'), ('bibtex', 'BibTeX')])
+    button = forms.SubmitField('Import')
+
 class YesNoForm(forms.FlaskForm):
     yes = forms.SubmitField('Yes')
     no = forms.SubmitField('No')
@@ -131,23 +146,20 @@ def add_citation():
 @dm.route('/add_data/<int:citation_id>', methods=['GET', 'POST'])
 @auth.verified_required
 def add_data(citation_id = None):
-    if citation_id:
-        if auth.current_user.auth_level >= auth.MODERATOR:
-            citation_choices = database.Citation.get_citations(sort=True, id=citation_id)
-        else:
-            citation_choices = database.Citation.get_citations(sort=True, id=citation_id,
-                                                                creator_id=auth.current_user.id)
-        if len(citation_choices) == 0:
-            render.flash_error('This citation either does not exist or you are not allowed to add data to it')
-            return render.redirect('dm.add_data')
+    # Moderators can add data to any citation, others only to their own
+    if auth.current_user.auth_level >= auth.MODERATOR:
+        where = {}
     else:
-        if auth.current_user.auth_level >= auth.MODERATOR:
-            citation_choices = database.Citation.get_citations(sort=True)
-        else:
-            citation_choices = database.Citation.get_citations(sort=True,
-                                                                creator_id=auth.current_user.id)
-        if len(citation_choices) == 0:
-            render.flash_error('There are currently no citations you can add data to')
+        where = dict(creator_id=auth.current_user.id)
+
+    # The citation is picked with a typeahead so only the selected citation is a choice
+    selected = citation_id or flask.request.form.get('citation', None, type=int)
+    citation_choices = database.Citation.get_citations(id=selected, **where) if selected else []
+    if citation_id and len(citation_choices) == 0:
+        render.flash_error('This citation either does not exist or you are not allowed to add data to it')
+        return render.redirect('dm.add_data')
+    elif not selected and len(database.Citation.get_citations(sort=False, limit=1, **where)) == 0:
+        render.flash_error('There are currently no citations you can add data to')
 
     form = add_data_form(citation_choices = citation_choices,
                          citation = citation_id,
@@ -155,12 +167,13 @@ def add_data(citation_id = None):
     if form.validate_on_submit():
         try:
             elements = [e.strip().capitalize() for e in form.element.data.split(',')]
-            for element in elements:
-                new_data = database.Data.new_entry(auth.current_user.id,
-                                                  creator_id=auth.current_user.id,
-                                                  citation_id=form.citation.data,
-                                                  sample_type=form.sample_type.choice,
-                                                  element=element)
+            with database.transaction():
+                for element in elements:
+                    new_data = database.Data.new_entry(auth.current_user.id,
+                                                      creator_id=auth.current_user.id,
+                                                      citation_id=form.citation.data,
+                                                      sample_type=form.sample_type.choice,
+                                                      element=element)
         except Exception as err:
             render.flash_error(str(err))
         else:
@@ -169,6 +182,61 @@ def add_data(citation_id = None):
     return render.template('form.html', form=form, markdown=add_data_markdown())
 
 
+@dm.route('/citations')
+@auth.verified_required
+def citations():
+    # Results for the citation typeahead of add_data
+    args = flask.request.args
+    if auth.current_user.auth_level >= auth.MODERATOR:
+        where = {}
+    else:
+        where = dict(creator_id=auth.current_user.id)
+
+    results = database.Citation.get_citations(search=args.get('q', '').strip(),
+                                              limit=min(max(args.get('limit', 20, type=int), 1), 100),
+                                              offset=max(args.get('offset', 0, type=int), 0),
+                                              **where)
+    return flask.jsonify(results=[dict(id=id, label=label) for id, label in results])
+
+
+# The columns that can be completed and their table
+COMPLETE_COLUMNS = {'journal': database.Citation, 'sample_type': database.Data}
+
+@dm.route('/complete/<column>')
+@auth.verified_required
+def complete(column):
+    # Results for the journal and sample type typeaheads
+    if column not in COMPLETE_COLUMNS:
+        flask.abort(404)
+
+    args = flask.request.args
+    values = COMPLETE_COLUMNS[column].complete(column, args.get('q', '').strip(),
+                                               limit=min(max(args.get('limit', 20, type=int), 1), 100))
+    return flask.jsonify(results=[dict(id=value, label=value) for value in values])
+
+
+@dm.route('/import', methods=['GET', 'POST'])
+@auth.moderator_required
+def import_data():
+    form = ImportForm()
+    errors = []
+
+    if form.validate_on_submit():
+        try:
+            text = form.file.data.read().decode('utf-8')
+            result = importer.import_file(auth.current_user.id, text, form.format.data)
+        except Exception as err:
+            render.flash_error(str(err))
+        else:
+            render.flash_success(f'Added {result.citations} citations and {result.data} data entries')
+            if result.errors:
+                render.flash_error(f'{len(result.errors)} rows were not imported')
+            errors = result.errors
+
+    return render.table('form_table.html', ('Line', 'Error'), errors, pagination=False,
+                        form=form, markdown=import_data_markdown())
+
+
 @dm.route('/edit', methods=['GET', 'POST'])
 @auth.verified_required
 def edit():
@@ -195,13 +263,24 @@ def edit():
         elif form.delete.data:
             return render.redirect(f'dm.delete_{form.table_.data.lower()}', id=form.id.data)
 
-    citations = dict(database.Citation.get_citations())
-    headings = ('Citation Id', 'Citation', 'Data Id', 'Sample Type', 'Element')
-    results = [(row.citation_id, citations[row.citation_id], row.id, row.sample_type, row.element)
-               for row in database.Data.get_all()]
+    return render.table('form_table.html', EDIT_HEADINGS, None, search=True,
+                        data_url=render.url_for('dm.edit_data_table'), form=form)
 
-    return render.table('form_table.html', headings, results, search=True,
-                        form=form)
+EDIT_HEADINGS = ('Citation Id', 'Citation', 'Data Id', 'Sample Type', 'Element')
+EDIT_SORT = ('citation_id', ('Citation.year', 'Citation.authors', 'Citation.journal'), 'id', 'sample_type', 'element')
+
+@dm.route('/edit/data')
+@auth.verified_required
+def edit_data_table():
+    total, results = database.Data.get_page(('citation_id', 'Citation.year', 'Citation.authors', 'Citation.journal',
+                                             'Citation.doi', 'id', 'sample_type', 'element'),
+                                            search_in=('Citation.authors', 'Citation.journal', 'Citation.doi',
+                                                       'sample_type', 'element'),
+                                            **render.table_args(EDIT_SORT))
+
+    results = [(row.citation_id, database.Citation.label(row.year, row.authors, row.journal, row.doi),
+                row.id, row.sample_type, row.element) for row in results]
+    return render.table_data(total, results)
 
 @dm.route('/delete_citation/<int:id>', methods=['GET', 'POST'])
 @auth.verified_required
@@ -331,6 +410,7 @@ def edit_data(id):
     return render.table('form_table.html', headings, reversed(results), form=form)
 
 
+@render.static_markdown
 def add_citation_markdown():
     return dict(
         before_form = """
@@ -349,6 +429,7 @@ def add_citation_markdown():
     )
 
 
+@render.static_markdown
 def add_data_markdown():
     return dict(
         before_form="""
@@ -364,6 +445,27 @@ def add_data_markdown():
     )
 
 
+@render.static_markdown
+def import_data_markdown():
+    return dict(
+        before_form="""
+        ### Import Data
+        Add many citations and data from a file at once. Rows with errors are skipped and listed below, all
+        other rows are imported. Data for a citation whose DOI is already in the database is added to that citation.
+
+        - **CSV**: A file with the columns ``authors``, ``year``, ``journal``, ``doi``, ``ads``, ``sample_type``
+        and ``element``. Multiple elements can be given in one row by separating them with ", ".
+        - **BibTeX**: Entries with the ``author``, ``year``, ``journal``, ``doi`` (or ``url``) and ``adsurl`` fields
+        and the data in the ``sample_type`` and ``element`` fields.
+
+        The CSV and BibTeX files exported from the search page can be imported.
+        """,
+        before_table="""
+        ### Errors
+        """
+    )
+
+
 def markdown_delete_thing(thing):
     return dict(
         before_form=f"""
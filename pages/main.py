@@ -1,6 +1,7 @@
+import flask
 from flask import Blueprint
 
-import forms, database, render
+import forms, database, render, export
 
 main = Blueprint('main', __name__)
 
@@ -9,6 +10,19 @@ main = Blueprint('main', __name__)
 #############
 
 class SearchForm(forms.FlaskForm):
+    # Searches are GET requests that can be bookmarked, shared and cached so there is no csrf token
+    class Meta:
+        csrf = False
+
+    sample_type = forms.SelectMultipleField('Sample Type:')
+    element = forms.SelectMultipleField('Element:')
+    search = forms.SubmitField('Search')
+
+class CitationSearchForm(forms.FlaskForm):
+    class Meta:
+        csrf = False
+
+    q = forms.StringField('Authors, Journal or DOI:')
     sample_type = forms.SelectMultipleField('Sample Type:')
     element = forms.SelectMultipleField('Element:')
     search = forms.SubmitField('Search')
@@ -20,22 +34,81 @@ class SearchForm(forms.FlaskForm):
 @main.route('/', methods=['GET', 'POST'])
 @main.route('/search', methods=['GET', 'POST'])
 def search():
-    form = SearchForm()
-    form.sample_type.choices = sorted(database.Data.get_all('sample_type', distinct=True))
-    form.element.choices = sorted(database.Data.get_all('element', distinct=True))
+    if flask.request.method == 'GET':
+        etag = render.etag(database.generation(), sorted(flask.request.args.items(multi=True)))
+        if response := render.not_modified(etag):
+            return response
+        form = SearchForm(formdata=flask.request.args or None)
+    else:
+        etag = None
+        form = SearchForm()
+
+    form.sample_type.choices = database.Data.get_facet('sample_type')
+    form.element.choices = database.Data.get_facet('element')
 
-    if form.validate_on_submit():
+    markdown = search_markdown()
+    if (form.is_submitted() or flask.request.args) and form.validate():
         headings, results = database.Data.get_search(sample_type=form.sample_type.data,
                                            element=form.element.data)
+        markdown.update(export_markdown(form.sample_type.data, form.element.data))
     else:
         headings, results = database.Data.get_search(headings_only=True)
 
-    return render.table('form_table.html', headings, results, result_types = {"Link": 'html'},
-                        form=form, markdown=search_markdown())
+    response = render.table('form_table.html', headings, results, result_types = {"Link": 'html'},
+                            form=form, form_method='get', markdown=markdown)
+    return render.cacheable(response, etag)
+
+CITATION_HEADINGS = ('Authors', 'Year', 'Journal', 'Link')
+CITATION_SORT = ('authors', 'year', 'journal', None)
+
+@main.route('/citations')
+def citations():
+    form = CitationSearchForm(formdata=flask.request.args or None)
+    form.sample_type.choices = database.Data.get_facet('sample_type')
+    form.element.choices = database.Data.get_facet('element')
+    form.validate()
+
+    data_url = render.url_for('main.citations_table', q=form.q.data or '',
+                              sample_type=form.sample_type.data or [], element=form.element.data or [])
+    return render.table('form_table.html', CITATION_HEADINGS, None, result_types={'Link': 'html'},
+                        data_url=data_url, form=form, form_method='get', markdown=citations_markdown())
+
+@main.route('/citations/data')
+def citations_table():
+    etag = render.etag(database.generation(), sorted(flask.request.args.items(multi=True)))
+    if response := render.not_modified(etag):
+        return response
+
+    args = render.table_args(CITATION_SORT)
+    total, results = database.Citation.search_text(flask.request.args.get('q', ''),
+                                                   limit=args['limit'], offset=args['offset'],
+                                                   order_by=args['order_by'], descending=args['descending'],
+                                                   sample_type=flask.request.args.getlist('sample_type'),
+                                                   element=flask.request.args.getlist('element'))
+
+    results = [(citation.authors, citation.year, citation.journal, citation.link()) for citation in results]
+    return render.cacheable(render.table_data(total, results), etag)
+
+@main.route('/export')
+def export_search():
+    args = flask.request.args
+    if args.get('format', 'csv') not in export.FORMATS:
+        flask.abort(400)
+    mimetype, extension, lines = export.FORMATS[args.get('format', 'csv')]
+
+    results = database.Data.iter_search(compress=args.get('compress', 'true') != 'false',
+                                        yield_per=500,
+                                        sample_type=args.getlist('sample_type'),
+                                        element=args.getlist('element'))
+
+    return flask.Response(flask.stream_with_context(lines(results)), mimetype=mimetype,
+                          headers={'Content-Disposition': f'attachment; filename=search.{extension}'})
+
 ############
 ### Text ###
 ############
 
+@render.static_markdown
 def search_markdown():
     return dict(
         before_table="""
@@ -47,3 +120,21 @@ def search_markdown():
         Select your sample type and element of interest from the form below and the papers
         containing this type of data will be displayed.
         """)
+
+@render.static_markdown
+def citations_markdown():
+    return dict(
+        before_form="""
+        ### Citations
+
+        Search the authors, journal and DOI of the citations. Every word must match the start of a
+        word in the citation, e.g. `ek mo` finds papers by Ek containing Mo. The best matches are shown first.
+        The citations can also be limited to those with data for a sample type and element.
+        """)
+
+def export_markdown(sample_type, element):
+    links = ' | '.join(f'[{name}]({render.url_for("main.export_search", sample_type=sample_type, element=element, format=format)})'
+                       for format, name in [('csv', 'CSV'), ('json', 'JSON'), ('bibtex', 'BibTeX')])
+    return dict(after_table=f"""
+        Download these results as: {links}
+        """)
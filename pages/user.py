@@ -121,6 +121,7 @@ def change_password():
 ############
 ### Text ###
 ############
+@render.static_markdown
 def markdown_login():
     return dict(
         after_form = f"""
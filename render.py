@@ -1,15 +1,19 @@
-import flask
+import flask, json, hashlib, functools
+import flask_login
 from flask import url_for
 from inspect import cleandoc
 from markdown import markdown as mkd
 
 __all__ = ['flash_message', 'flash_error', 'flash_success',
-           'template', 'redirect', 'table', 'url_for']
+           'template', 'markdown_html', 'static_markdown', 'precompile_markdown', 'redirect', 'table', 'table_args', 'table_data', 'url_for',
+           'script_json', 'etag', 'not_modified', 'cacheable']
 
 _app = None
 
 def init(app):
     globals()['_app'] = app
+    if app.config.get('MARKDOWN_PRECOMPILE', False):
+        precompile_markdown()
 
 def flash_message(message):
     flask.flash(message)
@@ -23,10 +27,48 @@ def flash_success(message):
 def redirect(funcname, **kwargs):
     return flask.redirect(flask.url_for(funcname, **kwargs))
 
+def etag(*parts):
+    """
+    Return a strong ETag for a response that only depends on ``parts`` and the current user.
+
+    Returns ``None`` if the response cannot be cached because there are flashed messages waiting to be shown.
+    """
+    if '_flashes' in flask.session:
+        return None
+
+    parts = (flask_login.current_user.get_id(),) + parts
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+def not_modified(etag):
+    """
+    Return an empty 304 response if the client already has the response with ``etag``, otherwise ``None``.
+    """
+    # Weak comparison, compressed responses have a weak ETag
+    if etag is not None and flask.request.if_none_match.contains_weak(etag):
+        return cacheable(flask.Response(status=304), etag)
+
+def cacheable(response, etag):
+    response = flask.make_response(response)
+    if etag is not None:
+        response.set_etag(etag)
+        # Caches must always check with us, but can then reuse their copy when they get a 304
+        if flask_login.current_user.is_authenticated:
+            response.cache_control.private = True
+        else:
+            response.cache_control.public = True
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+    return response
+
 def table(template, headings, results, result_types = None,
-                 search=False, pagination=True, **kwargs):
+                 search=False, pagination=True, data_url=None, **kwargs):
+    """
+    Render a Grid.js table.
+
+    If ``data_url`` is given ``results`` is ignored and the table instead fetches one page at a time from
+    ``data_url``, which should return ``table_data`` for the ``table_args`` of the request.
+    """
     heading_ids = [heading.replace(' ', '_') for heading in headings]
-    columns = ''.join([f"{{ id: '{hid}', name: '{heading}' }}, \n" for hid, heading in zip(heading_ids, headings)])
 
     if result_types is None:
         result_types = {}
@@ -38,20 +80,19 @@ def table(template, headings, results, result_types = None,
     elif type(result_types) is not dict:
         result_types = {h: result_types for h in headings}
 
-    data = []
-    for row in results:
-        row_data = ''
-        for i, column in enumerate(row):
-            result_type = result_types.get(headings[i], None)
-            if result_type == 'html':
-                column = f"gridjs.html('{column}')"
-            elif result_type == 'number' or (result_type is None and isinstance(column, (int, float))):
-                column = f"{column}"
-            else:
-                column = f'"{column}"'
-            row_data += f"{heading_ids[i]}: {column},\n"
-        data.append(f"{{\n{row_data}}}, \n")
-    data = ''.join(data)
+    columns = []
+    for hid, heading in zip(heading_ids, headings):
+        column = dict(id=hid, name=heading)
+        if result_types.get(heading, None) == 'html':
+            column['html'] = True  # Rendered with gridjs.html by the template
+        columns.append(column)
+    columns = script_json(columns)
+
+    if data_url is not None:
+        return _server_table(template, columns, data_url, search, pagination, **kwargs)
+
+    # Rows are given as arrays in the order of the columns
+    data = script_json([row if type(row) in (list, tuple) else tuple(row) for row in results])
 
     if search:
         search = 'true'
@@ -71,33 +112,117 @@ def table(template, headings, results, result_types = None,
                            table_search = search,
                            table_pagination = pagination,
                            **kwargs)
+
+def script_json(obj):
+    """
+    Return ``obj`` encoded as JSON that can be placed directly in a ``<script>`` element.
+
+    Values that are not JSON types, e.g. dates, are encoded as strings.
+    """
+    # Escapes the characters that could end the <script> element
+    return (json.dumps(obj, separators=(',', ':'), default=str)
+            .replace('<', '\\u003c').replace('>', '\\u003e').replace('&', '\\u0026'))
+
+def _server_table(template, columns, data_url, search, pagination, **kwargs):
+    server = f"""{{
+        url: {json.dumps(data_url)},
+        then: data => data.results,
+        total: data => data.total
+    }}"""
+
+    if search:
+        search = "{ server: { url: (prev, keyword) => tableUrl(prev, {search: keyword}) } }"
+    else:
+        search = 'false'
+
+    sort = """{
+        multiColumn: false,
+        server: {
+            url: (prev, columns) => columns.length ?
+                tableUrl(prev, {sort: columns[0].index, order: columns[0].direction === 1 ? 'asc' : 'desc'}) : prev
+        }
+    }"""
+
+    if pagination is True:
+        pagination = 30
+    pagination = f"""{{
+        limit: {int(pagination)},
+        summary: false,
+        server: {{ url: (prev, page, limit) => tableUrl(prev, {{limit: limit, offset: page * limit}}) }}
+    }}"""
+
+    return render_template(template,
+                           table_columns = columns,
+                           table_server = server,
+                           table_search = search,
+                           table_sort = sort,
+                           table_pagination = pagination,
+                           **kwargs)
+
+def table_args(columns, default_sort=None, default_descending=False, limit=30, max_limit=500):
+    """
+    Return the keyword arguments for ``ModelMixin.get_page`` from the arguments of a table data request.
+
+    ``columns`` is a list, with one entry for each heading of the table, of the column, or tuple of columns,
+    to sort by when that heading is selected.
     """
-        columns: [ { id: 'authors', name: 'Authors' },
-                       { id: 'year', name: 'Year' },
-                       { id: 'journal', name: 'Journal' },
-                       { id: 'sampletype', name: 'Sample Type' },
-                       { id: 'element', name: 'Element' },
-                       { id: 'link', name: 'Links' },
-            ],
-            data: [
-                {% for result in table_results %}
-                    {
-                        authors: '{{ result["authors"] }}',
-                        year: '{{ result["year"] }}',
-                        journal: '{{ result["journal"]|safe}}',
-                        sampletype: '{{ result["sampletype"] }}',
-                        element: '{{ result["element"] }}',
-                        link: gridjs.html('{{ result["link"]|safe }}'),
-                    },
-                {%  endfor %}
-            ],
-            """
+    args = flask.request.args
+
+    sort = args.get('sort', None, type=int)
+    if sort is not None and 0 <= sort < len(columns):
+        order_by = columns[sort]
+        descending = args.get('order', 'asc') == 'desc'
+    else:
+        order_by = default_sort
+        descending = default_descending
+
+    return dict(limit = min(max(args.get('limit', limit, type=int), 1), max_limit),
+                offset = max(args.get('offset', 0, type=int), 0),
+                order_by = order_by,
+                descending = descending,
+                search = args.get('search', '').strip() or None)
+
+def table_data(total, results):
+    """
+    Return the JSON response with one page of rows for a table rendered with a ``data_url``.
+    """
+    data = []
+    for row in results:
+        data.append([column if isinstance(column, (int, float, str)) or column is None else str(column)
+                     for column in row])
+
+    return flask.jsonify(total=total, results=data)
+
+# Functions returning markdown that does not change between requests
+_static_markdown = []
+
+@functools.lru_cache(maxsize=512)
+def markdown_html(text):
+    """
+    Return the html for the markdown ``text``. The html is cached by the text so that text that doesn't change
+    between requests is only converted once.
+    """
+    return mkd(cleandoc(text))
+
+def static_markdown(func):
+    """
+    Mark a function that returns the same markdown for every request so that it can be converted when the app
+    starts, see ``precompile_markdown``.
+    """
+    _static_markdown.append(func)
+    return func
+
+def precompile_markdown():
+    with _app.test_request_context():
+        for func in _static_markdown:
+            for text in func().values():
+                markdown_html(text)
 
 def template(template, *args, markdown = None, **kwargs):
     if markdown and type(markdown) is not dict:
         raise TypeError('markdown must be a dict')
     elif markdown:
-        kwargs.update({k: mkd(cleandoc(v)) for k,v in markdown.items()})
+        kwargs.update({k: markdown_html(v) for k,v in markdown.items()})
 
     return flask.render_template(template, *args, **kwargs)
 
@@ -0,0 +1,172 @@
+import os, json, mmap, array, struct, threading, tempfile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import database
+from database import db
+
+__all__ = ['SearchSnapshot', 'search_snapshot', 'build', 'write']
+
+# File layout: MAGIC, the length of the header, the JSON header and then the column arrays, each starting at a
+# multiple of 8 bytes. The header holds the generation of the database the snapshot was made from, the number
+# of rows, the sample type and element dictionaries and the offset of each array.
+MAGIC = b'CHIESNP1'
+COLUMNS = {'citation_id': 'I', 'sample_type': 'H', 'element': 'H'}  # name: array typecode
+
+def _pad(size):
+    # Rounds size up to a multiple of 8
+    return -(-size // 8) * 8
+
+def init(app):
+    search_snapshot.path = app.config.get('SEARCH_SNAPSHOT_PATH', None)
+    if app.config.get('SEARCH_BACKEND', 'index') == 'snapshot':
+        # Without numpy searching the snapshot is slower than the index
+        if numpy is None:
+            raise RuntimeError("SEARCH_BACKEND 'snapshot' requires numpy")
+        database.search_backend = search_snapshot
+
+@database.with_app_context
+def build():
+    """
+    Return the generation, the sample types, the elements and the column arrays of the Data table ordered by
+    citation id. Sample types and elements are stored as their index in the sample type and element lists.
+    """
+    generation = database.generation(data=True)  # Read first, a write made while building makes the snapshot stale
+
+    codes = dict(sample_type={}, element={})
+    columns = {name: array.array(typecode) for name, typecode in COLUMNS.items()}
+    query = (db.select(database.Data.citation_id, database.Data.sample_type, database.Data.element)
+             .order_by(database.Data.citation_id))
+    for row in db.session.execute(query):
+        for name, value in zip(COLUMNS, row):
+            if name != 'citation_id':
+                value = codes[name].setdefault(value, len(codes[name]))
+            columns[name].append(value)
+
+    return generation, list(codes['sample_type']), list(codes['element']), columns
+
+def write(path, generation, sample_types, elements, columns):
+    """
+    Write a snapshot to ``path``. It is written to a temporary file that then replaces ``path`` so that
+    readers either see the old or the new snapshot.
+    """
+    offsets, size = {}, 0
+    for name, column in columns.items():
+        offsets[name] = size
+        size += _pad(len(column) * column.itemsize)
+
+    header = json.dumps(dict(generation=generation, rows=len(columns['citation_id']),
+                             sample_types=sample_types, elements=elements, offsets=offsets)).encode()
+    start = _pad(len(MAGIC) + 4 + len(header))
+
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, prefix='.snapshot-', delete=False) as file:
+        try:
+            file.write(MAGIC + struct.pack('<I', len(header)) + header)
+            for name, column in columns.items():
+                file.seek(start + offsets[name])
+                file.write(column.tobytes())
+            file.truncate(start + size)
+            file.flush()
+            os.fsync(file.fileno())
+        except BaseException:
+            os.remove(file.name)
+            raise
+    os.replace(file.name, path)
+
+class SearchSnapshot:
+    """
+    Memory mapped columnar copy of the Data table that answers the same searches as ``SearchIndex``.
+
+    The snapshot is a file shared by all the worker processes, so there is only one copy of it in the page cache.
+    It is rebuilt, by whichever worker first notices, when the data generation of the database has changed.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.generation = None
+        self.header = None
+        self.columns = None
+        self.map = None
+
+    def _open(self):
+        if not os.path.exists(self.path):
+            return False
+
+        with open(self.path, 'rb') as file:
+            map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if map[:len(MAGIC)] != MAGIC:
+            return False
+
+        length = struct.unpack('<I', map[len(MAGIC):len(MAGIC) + 4])[0]
+        header = json.loads(map[len(MAGIC) + 4:len(MAGIC) + 4 + length])
+        start = _pad(len(MAGIC) + 4 + length)
+
+        columns = {}
+        for name, typecode in COLUMNS.items():
+            offset = start + header['offsets'][name]
+            size = header['rows'] * array.array(typecode).itemsize
+            columns[name] = memoryview(map)[offset:offset + size].cast(typecode)
+            if numpy is not None:
+                columns[name] = numpy.frombuffer(columns[name], dtype=numpy.dtype(typecode))
+
+        self.header, self.columns, self.map = header, columns, map
+        self.generation = header['generation']
+        return True
+
+    def _refresh(self):
+        # Use the newest snapshot, building it if no worker has made one for the current data generation
+        generation = database.generation(data=True)
+        if self.generation == generation:
+            return
+        if self._open() and self.generation == generation:
+            return
+        write(self.path, *build())
+        self._open()
+
+    def search(self, sample_type=None, element=None, **where):
+        """
+        Return a sorted list of the ids of citations with data matching ``sample_type`` and ``element``.
+
+        Like ``Data.get_query`` an empty list or ``None`` matches everything. Returns ``None`` if the search
+        cannot be answered by the snapshot.
+        """
+        if (self.path is None or where or type(sample_type) not in (list, type(None))
+                or type(element) not in (list, type(None))):
+            return None
+
+        with self.lock:
+            self._refresh()
+            header, columns = self.header, self.columns
+
+        # Which codes are selected
+        selected = []
+        for column, values in [('sample_type', sample_type), ('element', element)]:
+            codes = {v: i for i, v in enumerate(header[f'{column}s'])}
+            if values:
+                selected.append((column, [codes[v] for v in values if v in codes]))
+
+        if numpy is not None:
+            mask = numpy.ones(header['rows'], dtype=bool)
+            for column, codes in selected:
+                mask &= numpy.isin(columns[column], codes)
+            return numpy.unique(columns['citation_id'][mask]).tolist()
+        else:
+            citation_ids = columns['citation_id']
+            rows = range(header['rows'])
+            for column, codes in selected:
+                lookup = bytearray(len(header[f'{column}s']))
+                for code in codes:
+                    lookup[code] = 1
+                values = columns[column]
+                rows = [i for i in rows if lookup[values[i]]]
+            # The rows are ordered by citation id
+            return list(dict.fromkeys(citation_ids[i] for i in rows))
+
+search_snapshot = SearchSnapshot()
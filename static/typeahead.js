@@ -0,0 +1,41 @@
+// Adds a search box above every select with a data-typeahead url. What is typed is sent to the url as q and
+// the options of the select are replaced by the results, a JSON object with a list of {id, label}. The first
+// data-typeahead-keep options are always kept.
+document.querySelectorAll('select[data-typeahead]').forEach((select) => {
+    const input = document.createElement('input');
+    input.type = 'search';
+    input.className = 'form-control mb-1';
+    input.placeholder = select.dataset.placeholder || 'Search';
+    input.setAttribute('aria-label', input.placeholder);
+    select.before(input);
+
+    let timer = null;
+    let controller = null;
+    async function update() {
+        if (controller) {
+            controller.abort();
+        }
+        controller = new AbortController();
+
+        const url = new URL(select.dataset.typeahead, window.location.href);
+        url.searchParams.set('q', input.value);
+        try {
+            const response = await fetch(url, {signal: controller.signal, headers: {Accept: 'application/json'}});
+            const data = await response.json();
+            const keep = Array.from(select.options).slice(0, Number(select.dataset.typeaheadKeep || 0));
+            select.replaceChildren(...keep, ...data.results.map(({id, label}) => new Option(label, id)));
+        } catch (err) {
+            if (err.name !== 'AbortError') {
+                throw err;
+            }
+        }
+    }
+
+    input.addEventListener('input', () => {
+        clearTimeout(timer);
+        timer = setTimeout(update, 200);
+    });
+    if (select.options.length <= Number(select.dataset.typeaheadKeep || 0)) {
+        update();
+    }
+});
@@ -2,14 +2,19 @@ from app import create_app
 import pytest
 from werkzeug.security import generate_password_hash
 from flask_login import  login_user
-import database, auth, config
-import re, csv, os
+import database, auth, config, importer, migrations, render, compression, assets, asgi, snapshot, backup
+import re, csv, os, json, io, gzip, shutil, asyncio, datetime, threading, sqlite3
+import sqlalchemy
 
 @database.with_app_context
 def reset_db():
     db = database.db
+    db.session.remove()
     db.drop_all()
     db.create_all()
+    database.search_index.clear()
+    database.facet_cache.clear()
+    database.autocomplete.clear()
 
     admin = database.User(name='admin',
                          auth_level=auth.ADMIN,
@@ -73,14 +78,23 @@ def reset_db():
                                            sample_type=row['sample_type'],
                                            element=row['element'])
 
+def remove_test_db():
+    # A WAL file left next to a new database would be applied to it
+    for path in [config.test_db_path, config.test_db_path + '-wal', config.test_db_path + '-shm']:
+        if os.path.exists(path):
+            os.remove(path)
+
 @pytest.fixture(scope='module')
 def app():
+    remove_test_db()
     app = create_app(testing=True)
     reset_db()
     with app.app_context():
         yield app
+        database.db.session.remove()
+        database.db.engine.dispose()
     #yield app
-    os.remove(config.test_db_path)
+    remove_test_db()
 
 @pytest.fixture()
 def client(app):
@@ -116,19 +130,39 @@ def modifies_db(app):
     yield database.db
     reset_db()
 
+def table_rows(html):
+    # The rows of a table rendered with data
+    match = re.search(r'^\s*data: (\[.*\]),$', html, re.MULTILINE)
+    return json.loads(match.group(1)) if match else []
+
 def test_search(client):
     response = client.get('/search')
     assert response.status_code == 200
-    assert response.text.count('Authors') == 2 #Empty table
+    assert len(table_rows(response.text)) == 0 #Empty table
 
     response = client.post('/search')
     assert response.status_code == 200
-    assert response.text.count('Authors') == 2 + 35  # All records
+    assert len(table_rows(response.text)) == 35  # All records
 
     response = client.post('/search', data=dict(element=['Mo']))
     assert response.status_code == 200
-    assert response.text.count('Authors') == 2 + 4  # Only those containing Mo
+    assert len(table_rows(response.text)) == 4  # Only those containing Mo
+
+def test_get_search(app):
+    headings, results = database.Data.get_search(element=['Mo'], sample_type=['Wholerock'])
+    citation_ids = sorted({d.citation_id for d in database.Data.get_all(element='Mo', sample_type='Wholerock')})
+    assert len(results) == len(citation_ids) == 3
+
+    for row, citation_id in zip(results, citation_ids):
+        citation = database.Citation.get_one(id=citation_id)
+        data = database.Data.get_all(citation_id=citation_id)
+        assert row[:3] == (citation.authors, citation.year, citation.journal)
+        assert row[3] == ', '.join(dict.fromkeys(d.sample_type for d in data))
+        assert row[4] == ', '.join(dict.fromkeys(d.element for d in data))
+        assert row[5].startswith(f'<a href="https://doi.org/{citation.doi}">DOI</a>')
 
+    headings, results = database.Data.get_search(compress=False, element=['Mo'])
+    assert [r[4] for r in results] == ['Mo'] * 4
 
 def test_login(client, anonymous):
     assert auth.current_user.is_anonymous
@@ -345,4 +379,992 @@ def test_citation_doi(client, verified, modifies_db):
     assert database.Citation.get_one(id=ncitations).doi == 'https://www.reference.co.uk/page'
     assert len(database.Citation.get_all()) == ncitations
 
+def search_index_equivalent():
+    searches = [dict(), dict(element=[]), dict(element=['Mo']), dict(element=['Mo', 'Pd', 'Ge']),
+                dict(sample_type=['CAI']), dict(sample_type=['Wholerock', 'CAI'], element=['Mo', 'Ru']),
+                dict(sample_type=['Wholerock'], element=['Xx'])]
+    for where in searches:
+        assert database.Data.get_search(**where) == database.Data.get_search(use_index=False, **where)
+
+def test_search_index(client, moderator, modifies_db):
+    search_index_equivalent()
+
+    citation_id, data_ids = dm_add(client, True)
+    search_index_equivalent()
+
+    dm_edit(client, True, citation_id, data_ids[0])
+    search_index_equivalent()
+
+    dm_remove(client, True, citation_id, data_ids[0])
+    search_index_equivalent()
+
+def test_table_data(client, moderator):
+    response = client.get('/dm/edit')
+    assert response.status_code == 200
+    assert '/dm/edit/data' in response.text
+
+    ndata = len(database.Data.get_all())
+    response = client.get('/dm/edit/data?limit=10&offset=30')
+    assert response.json['total'] == ndata
+    assert [row[2] for row in response.json['results']] == list(range(31, min(41, ndata + 1)))
+
+    response = client.get('/dm/edit/data?search=CAI&limit=100')
+    assert response.json['total'] == len(database.Data.get_all(sample_type='CAI'))
+    assert [row[3] for row in response.json['results']] == ['CAI'] * response.json['total']
+
+    response = client.get('/dm/edit/data?sort=4&order=desc&limit=100')
+    elements = [row[4] for row in response.json['results']]
+    assert elements == sorted(elements, reverse=True)
+
+def test_export(client):
+    response = client.get('/export?element=Mo&format=csv')
+    assert response.status_code == 200
+    assert response.is_streamed
+    lines = list(csv.DictReader(response.text.splitlines()))
+    assert len(lines) == 4
+    assert all('Mo' in line['element'].split(', ') for line in lines)
+
+    response = client.get('/export?element=Mo&format=json&compress=false')
+    lines = response.text.splitlines()
+    assert len(lines) == 4
+    assert all(json.loads(line)['element'] == 'Mo' for line in lines)
+
+    response = client.get('/export?element=Mo&sample_type=CAI&format=bibtex')
+    assert response.text.count('@article{') == 1
+    assert 'element = {' in response.text
+
+    assert client.get('/export?format=xml').status_code == 400
+
+def test_facet_cache(client, moderator, modifies_db):
+    queries = []
+    def count_query(*args):
+        queries.append(args)
+
+    client.get('/search')
+    client.get('/dm/add_citation')
+    sqlalchemy.event.listen(database.db.engine, 'before_cursor_execute', count_query)
+    try:
+        response = client.get('/search')
+        # Only the generations, once for the ETag and the facets
+        assert len(queries) == 1 and 'FROM attrs' in queries[0][2]
+        queries.clear()
+        assert '>CAI</option>' in response.text
+
+        client.get('/dm/add_citation')
+        assert len(queries) == 0
+
+        # A write only drops the facets of the columns it changed
+        database.Citation.update_entry(1, 1, authors='Facet, F')
+        queries.clear()
+        client.get('/search')
+        assert len(queries) == 1 and 'FROM attrs' in queries[0][2]
+        queries.clear()
+        database.Data.update_entry(1, 1, element='Zr')
+        client.get('/search')
+        assert len([q for q in queries if 'GROUP BY data.element' in q[2]]) == 1
+        assert not [q for q in queries if 'GROUP BY data.sample_type' in q[2]]
+    finally:
+        sqlalchemy.event.remove(database.db.engine, 'before_cursor_execute', count_query)
+
+    assert database.Data.get_facet('sample_type', counts=True)['CAI'] == len(database.Data.get_all(sample_type='CAI'))
+
+    client.post('/dm/add_data', data=dict(citation=1, sample_type='<New Sample Type>',
+                                          sample_type_new='Hibonite', element='Ca'))
+    assert 'Hibonite' in database.Data.get_facet('sample_type')
+    assert '>Hibonite</option>' in client.get('/search').text
+
+def test_search_permalink(client, moderator, modifies_db):
+    response = client.get('/search?element=Mo')
+    assert response.status_code == 200
+    assert len(table_rows(response.text)) == 4
+    assert response.headers['ETag']
+
+    etag = response.headers['ETag']
+    response = client.get('/search?element=Mo', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+    response = client.get('/search?element=Mo&element=Pd', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+    generation = database.generation()
+    dm_add(client, True)
+    assert database.generation() > generation
+
+    response = client.get('/search?element=Mo', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+def test_all_edits(client, moderator, modifies_db):
+    edits = database.Edit.get_all()
+    edits = sorted(edits, key=lambda e: (e.datetime, e.id), reverse=True)
+
+    ids, before = [], None
+    while True:
+        results, before = database.Edit.get_log(20, before)
+        ids += [row.id for row in results]
+        if before is None:
+            break
+    assert ids == [e.id for e in edits]
+
+    results, before = database.Edit.get_log(50, table='Data', item_id=3)
+    assert [row.column for row in results] == ['CREATED']
 
+    response = client.get('/admin/all_edits')
+    assert response.status_code == 200
+    assert 'Older edits' in response.text
+    before = re.search('before=([^&"]*)', response.text).group(1)
+
+    response = client.get(f'/admin/all_edits?before={before}')
+    assert response.status_code == 200
+    assert 'Newest edits' in response.text
+    for before in ['2024-01-01', '2024-01-01_x', 'x_1', '']:
+        assert client.get('/admin/all_edits', query_string=dict(before=before)).status_code == 400
+
+    response = client.get('/admin/all_edits?table_=Citation&item_id=1')
+    assert response.text.count('CREATED') == 1
+    assert 'Older edits' not in response.text
+
+def test_import(client, moderator, modifies_db, tmp_path):
+    ncitations = len(database.Citation.get_all())
+    ndata = len(database.Data.get_all())
+    nedits = len(database.Edit.get_all())
+
+    text = ('authors,year,journal,doi,ads,sample_type,element\n'
+            'Test; A,2021,Test Journal,10.1234/import1,,Wholerock,"Pd, Pt"\n'
+            'Test; A,2021,Test Journal,https://doi.org/10.1234/import1,,CAI,Ru\n'
+            'Test; B,20x1,Test Journal,10.1234/import2,,Wholerock,Pd\n'
+            'Test; C,2022,Test Journal,10.1234/import3,,Wholerock,Pdd\n'
+            'Test; D,2022,Test Journal,https://www.citation.com/import,,Wholerock,Mo\n'
+            'Ek; M,2020,Nature Astronomy,10.1038/s41550-019-0948-z,,Wholerock,Ag\n')
+    result = importer.import_file(1, text, 'csv')
+    assert result.citations == 2
+    assert result.data == 5
+    assert [line for line, error in result.errors] == [4, 5]
+    assert len(database.Citation.get_all()) == ncitations + 2
+    assert len(database.Data.get_all()) == ndata + 5
+    assert len(database.Edit.get_all()) == nedits + 7
+    assert 'Ag' in database.Data.get_all('element', citation_id=1)
+    assert 'Test Journal' in database.Citation.get_facet('journal')
+
+    bibtex = client.get('/export?element=Pd&format=bibtex').text
+    response = client.post('/dm/import', data=dict(file=(io.BytesIO(bibtex.encode()), 'export.bib'),
+                                                   format='bibtex'))
+    assert response.status_code == 200
+    assert len(database.Citation.get_all()) == ncitations + 2
+
+    path = tmp_path / 'import.csv'
+    path.write_text(text.replace('import', 'cli'))
+    result = client.application.test_cli_runner().invoke(args=['import-data', str(path), '--user', 'admin@test.com'])
+    assert 'Added 2 citations and 5 data entries' in result.output
+    assert len(database.Citation.get_all()) == ncitations + 4
+
+def test_transaction(client, moderator, modifies_db):
+    commits = []
+    def count_commit(*args):
+        commits.append(args)
+
+    ndata = len(database.Data.get_all())
+    nedits = len(database.Edit.get_all())
+
+    sqlalchemy.event.listen(database.db.engine, 'commit', count_commit)
+    try:
+        data = database.Data.new_entry(1, creator_id=1, citation_id=1, sample_type='CAI', element='Zr')
+        assert len(commits) == 1
+        assert data.id == ndata + 1 and data.element == 'Zr'
+
+        client.post('/dm/add_data', data=dict(citation=1, sample_type='CAI', element='Nb, Hf, W'))
+        assert len(commits) == 2
+        assert len(database.Data.get_all()) == ndata + 4
+
+        ncitationdata = len(database.Data.get_all(citation_id=1))
+        database.Citation.delete(1, 1)
+        assert len(commits) == 3
+        assert len(database.Edit.get_all()) == nedits + 4 + 1 + ncitationdata
+    finally:
+        sqlalchemy.event.remove(database.db.engine, 'commit', count_commit)
+
+    with pytest.raises(ValueError):
+        with database.transaction():
+            database.Data.new_entry(1, creator_id=1, citation_id=2, sample_type='CAI', element='Zr')
+            raise ValueError()
+    assert len(database.Data.get_all(citation_id=2, element='Zr')) == 0
+    search_index_equivalent()
+
+def test_concurrent_reads(app):
+    engine = database.db.engine
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql('PRAGMA journal_mode').scalar() == 'wal'
+        assert connection.exec_driver_sql('PRAGMA busy_timeout').scalar() == app.config['SQLITE_PRAGMAS']['busy_timeout']
+
+    ndata = len(database.Data.get_all())
+    nreaders = 4
+    errors, counts = [], []
+    reading = threading.Barrier(nreaders + 1, timeout=10)
+    write_open, committed = threading.Event(), threading.Event()
+    read_during_write = threading.Semaphore(0)
+
+    def count(connection):
+        return connection.exec_driver_sql('SELECT count(*) FROM data').scalar()
+
+    def read():
+        try:
+            with engine.connect() as connection:
+                # A read transaction, like a slow page, that stays open while the data is written. pysqlite only
+                # begins transactions before writes.
+                connection.exec_driver_sql('BEGIN')
+                before = count(connection)
+                reading.wait()
+                assert write_open.wait(timeout=10)
+                during = count(connection)
+                read_during_write.release()
+                assert committed.wait(timeout=10)
+                after = count(connection)
+                connection.rollback()
+                counts.append((before, during, after, count(connection)))
+        except Exception as err:
+            errors.append(err)
+
+    readers = [threading.Thread(target=read) for i in range(nreaders)]
+    for reader in readers:
+        reader.start()
+
+    try:
+        reading.wait()
+        with engine.connect() as writer:
+            writer.exec_driver_sql("INSERT INTO data (citation_id, creator_id, sample_type, element) "
+                                   "VALUES (1, 1, 'Test', 'Xx')")
+            write_open.set()
+            # Every reader reads while the write transaction is open
+            for reader in readers:
+                assert read_during_write.acquire(timeout=10)
+            # and the write is committed while their read transactions are open
+            writer.commit()
+            committed.set()
+    finally:
+        write_open.set()
+        committed.set()
+        for reader in readers:
+            reader.join()
+        with engine.begin() as writer:
+            writer.exec_driver_sql("DELETE FROM data WHERE sample_type = 'Test'")
+
+    assert not errors
+    # The readers see the data as it was when their read transaction started until it ends
+    assert counts == [(ndata, ndata, ndata, ndata + 1)] * nreaders
+
+def query_plan(query):
+    sql = str(query.compile(database.db.engine, compile_kwargs={'literal_binds': True}))
+    return ' '.join(row[3] for row in database.db.session.execute(sqlalchemy.text(f'EXPLAIN QUERY PLAN {sql}')))
+
+def test_migrations(app):
+    with database.db.engine.begin() as connection:
+        connection.exec_driver_sql('PRAGMA user_version = 0')
+        connection.exec_driver_sql('DROP INDEX ix_data_element_sample_type_citation_id')
+        connection.exec_driver_sql('DROP TABLE citation_fts')
+
+    assert migrations.upgrade() == [(1, 'Add indexes for the search, edit history and edit log'),
+                                    (2, 'Add the full text index of the citations'),
+                                    (3, 'Add an index for the citation listing')]
+    assert database.Citation.search_text('schonbachler')[0] == 10
+    assert migrations.get_version() == migrations.MIGRATIONS[-1][0]
+    assert migrations.upgrade() == []
+
+    result = app.test_cli_runner().invoke(args=['db-upgrade'])
+    assert f'The database is at version {migrations.MIGRATIONS[-1][0]}' in result.output
+
+    # Which index is used for the filter depends on the statistics of the table
+    for where in [dict(element=['Mo', 'Pd'], sample_type=['CAI']), dict(element=['Mo']), dict(sample_type=['CAI'])]:
+        plan = query_plan(database.Data.search_query(**where))
+        assert 'SCAN data' not in plan
+        assert re.search('SEARCH data USING (COVERING )?INDEX ix_data_(element|sample_type)_', plan)
+        assert 'SEARCH data USING COVERING INDEX ix_data_citation_id_sample_type_element' in plan
+
+    query, scalar = database.Edit.get_query(('User.name', 'datetime', 'table', 'item_id', 'column',
+                                             'old_value', 'new_value'), item_id=1, table='Citation')
+    assert 'USING INDEX ix_edit_table_item_id_datetime' in query_plan(query)
+
+    plan = query_plan(database.Edit.get_query('id')[0].order_by(database.Edit.datetime.desc(), database.Edit.id.desc()))
+    assert 'ix_edit_datetime_id' in plan
+
+    citation = database.Citation
+    query = citation.get_query(('id', 'year', 'authors', 'journal', 'doi'))[0]
+    plan = query_plan(query.order_by(citation.year, citation.authors, citation.journal, citation.id).limit(20))
+    assert 'SCAN citation USING COVERING INDEX ix_citation_year_authors_journal_doi' in plan
+
+def test_reuse_app_context(app):
+    @database.with_app_context
+    def get_session():
+        return database.db.session()
+
+    # Calls in the app context use its session
+    assert get_session() is database.db.session()
+
+    # Calls outside of the app push their own context
+    sessions = []
+    thread = threading.Thread(target=lambda: sessions.append(get_session()))
+    thread.start()
+    thread.join()
+    assert sessions[0] is not database.db.session()
+
+def test_query_cache(app):
+    what = ('User.name', 'datetime', 'table', 'item_id', 'column', 'old_value', 'new_value')
+    expected = database.db.session.execute(
+        database.db.select(database.User.name, database.Edit.datetime, database.Edit.table, database.Edit.item_id,
+                           database.Edit.column, database.Edit.old_value, database.Edit.new_value)
+        .join(database.User).where(database.Edit.table == 'Citation', database.Edit.item_id == 2)).all()
+
+    database._query_cache.clear()
+    assert database.Edit.get_all(what, table='Citation', item_id=2) == expected
+    assert len(database._query_cache) == 1
+
+    # Only the values differ so the cached statement is used
+    assert database.Edit.get_all(list(what), table='Citation', item_id=2) == expected
+    assert database.Edit.get_all(what, table='Citation', item_id=1) != expected
+    assert len(database._query_cache) == 1
+
+    # Operators are part of the key
+    assert database.Data.get_all('element', citation_id=[1]) == database.Data.get_all('element', citation_id_in=[1])
+    assert database.Data.get_all('element', citation_id=[]) == database.Data.get_all('element')
+    assert database.Data.get_all(citation_id_eq=None) == []
+
+    # get_query returns the statement with the values bound
+    query, scalar = database.Data.get_query('element', id=1)
+    assert database.db.session.execute(query).scalar_one() == database.Data.get_one('element', id=1)
+
+def test_user_cache(client, modifies_db):
+    queries = []
+    def count_query(*args):
+        queries.append(args)
+
+    database.user_cache.clear()
+    moderator = database.user_cache.get(2)
+    assert moderator.name == 'moderator' and moderator.auth_level == auth.MODERATOR
+    assert not hasattr(moderator, '__dict__')
+    assert database.user_cache.get(999) is None
+
+    sqlalchemy.event.listen(database.db.engine, 'before_cursor_execute', count_query)
+    try:
+        assert database.user_cache.get(2) is moderator
+        assert len(queries) == 0
+    finally:
+        sqlalchemy.event.remove(database.db.engine, 'before_cursor_execute', count_query)
+
+    # Changing the role or password of the user invalidates it
+    database.User.update_entry(1, 2, auth_level=auth.VERIFIED)
+    assert database.user_cache.get(2).auth_level == auth.VERIFIED
+    cached = database.user_cache.get(2)
+    database.User.update_password(2, 'new password')
+    assert database.user_cache.get(2) is not cached
+
+    # Expired entries are loaded again
+    database.user_cache.ttl = 0
+    try:
+        assert database.user_cache.get(1) is not database.user_cache.get(1)
+    finally:
+        database.user_cache.ttl = config.Test.USER_CACHE_TTL
+
+    # Logged in requests use the cache
+    assert client.application.login_manager._user_callback('2') is database.user_cache.get(2)
+
+def test_password_rehash(client, modifies_db):
+    # The test users are created with werkzeug's default method
+    pwhash = database.User.get_one('password', id=3)
+    assert auth.needs_rehash(pwhash)
+
+    assert not database.User.verify_password(3, 'wrong password')
+    assert database.User.get_one('password', id=3) == pwhash
+
+    assert database.User.verify_password(3, 'password')
+    new_pwhash = database.User.get_one('password', id=3)
+    assert new_pwhash.startswith('pbkdf2:sha256:1000$')
+    assert not auth.needs_rehash(new_pwhash)
+    assert database.User.verify_password(3, 'password')
+    assert database.User.get_one('password', id=3) == new_pwhash
+
+    database.User.update_password(3, 'new password')
+    assert not auth.needs_rehash(database.User.get_one('password', id=3))
+    assert database.User.verify_password(3, 'new password')
+
+def test_table_json(app):
+    results = [(1, 'O\'Neil, "A."', '<a href="https://doi.org/10.1/x">DOI</a>'),
+               (2, '</script><script>alert(1)</script>', None)]
+    with app.test_request_context():
+        database.flask.g.pop('_login_user', None)  # Logged in by an earlier test
+        html = render.table('table.html', ['Id', 'Authors', 'Link'], results, result_types={'Link': 'html'})
+
+    assert '</script><script>alert' not in html
+    assert table_rows(html) == [list(row) for row in results]
+    columns = re.search(r'const columns = (\[.*\])\.map', html).group(1)
+    assert json.loads(columns) == [dict(id='Id', name='Id'), dict(id='Authors', name='Authors'),
+                                   dict(id='Link', name='Link', html=True)]
+
+def test_compression(client, app):
+    rows = [(f'Author{i}, A.; Author{i + 1}, B.', 1950 + i % 70, 'Geochimica et Cosmochimica Acta', 'CAI', 'Mo',
+             f'<a href="https://doi.org/10.1016/j.gca.{i}">DOI</a>') for i in range(10_000)]
+
+    wire = {}
+    for encoding in ['identity', 'gzip']:
+        with app.test_request_context(headers={'Accept-Encoding': encoding}):
+            database.flask.g.pop('_login_user', None)  # Logged in by an earlier test
+            response = app.make_response(render.table('table.html', ['Authors', 'Year', 'Journal', 'Sample Type',
+                                                                     'Element', 'Link'], rows))
+            response = compression.compress(response)
+            wire[encoding] = len(response.get_data())
+            if encoding == 'gzip':
+                assert response.headers['Content-Encoding'] == 'gzip'
+                body = gzip.decompress(response.get_data())
+            else:
+                assert 'Content-Encoding' not in response.headers
+    assert len(body) == wire['identity']
+    assert wire['gzip'] < wire['identity'] / 10  # 1.6MB -> ~100kB
+
+    # Pages
+    response = client.get('/search', query_string=dict(sample_type='CAI'), headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert response.headers['ETag'].startswith('W/')
+    assert len(table_rows(gzip.decompress(response.get_data()).decode())) > 0
+    assert client.get('/search', query_string=dict(sample_type='CAI'), headers={
+        'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']}).status_code == 304
+
+    response = client.get('/search', query_string=dict(sample_type='CAI'))
+    assert 'Content-Encoding' not in response.headers
+
+    # Streamed exports
+    response = client.get('/export', query_string=dict(format='csv'), headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.get_data()).decode() == client.get('/export', query_string=dict(format='csv')).text
+
+    # Small responses are not compressed
+    with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+        response = compression.compress(database.flask.jsonify(total=1, results=[[1, 'CAI']]))
+        assert 'Content-Encoding' not in response.headers
+
+    # Precompressed static files
+    paths = compression.compress_static(app.static_folder)
+    try:
+        assert os.path.join(app.static_folder, 'main.css') in paths
+        response = client.get('/static/main.css', headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        with open(os.path.join(app.static_folder, 'main.css'), 'rb') as file:
+            assert gzip.decompress(response.get_data()) == file.read()
+        response.close()
+        response = client.get('/static/main.css')
+        assert 'Content-Encoding' not in response.headers
+        response.close()
+    finally:
+        for path in paths:
+            for extension in compression.ENCODINGS.values():
+                if os.path.exists(path + extension):
+                    os.remove(path + extension)
+
+def test_assets(client, app):
+    with app.test_request_context():
+        url = assets.asset_url('main.css')
+    assert re.fullmatch(r'/static/main\.[0-9a-f]{12}\.css', url)
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.cache_control.immutable and response.cache_control.max_age == assets.IMMUTABLE_MAX_AGE
+    with open(os.path.join(app.static_folder, 'main.css'), 'rb') as file:
+        assert response.get_data() == file.read()
+    response.close()
+
+    assert client.get('/static/main.000000000000.css').status_code == 404
+    response = client.get('/static/main.css')
+    assert response.status_code == 200 and not response.cache_control.immutable
+    response.close()
+
+    # Vendored files are used from the download location until they have been downloaded
+    filename = 'vendor/gridjs/gridjs.umd.js'
+    path = os.path.join(app.static_folder, *filename.split('/'))
+    if not os.path.exists(path):
+        with app.test_request_context():
+            assert assets.asset_url(filename) == assets.VENDOR[filename]
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            with open(path, 'w') as file:
+                file.write('var gridjs = {};')
+            assets.load_manifest()
+            with app.test_request_context():
+                url = assets.asset_url(filename)
+            assert url.startswith('/static/vendor/gridjs/gridjs.umd.')
+            response = client.get(url)
+            assert response.text == 'var gridjs = {};'
+            response.close()
+        finally:
+            os.remove(path)
+            assets.load_manifest()
+
+    # The manifest can only be written with all the vendored files and is then used instead of the static folder
+    runner = app.test_cli_runner()
+    missing = [os.path.join(app.static_folder, *filename.split('/')) for filename in assets.VENDOR]
+    missing = [path for path in missing if not os.path.exists(path)]
+    manifest_path = os.path.join(app.static_folder, 'manifest.json')
+    try:
+        if missing:
+            result = runner.invoke(args=['assets', 'manifest'])
+            assert result.exit_code != 0 and "'flask assets vendor'" in result.output
+            assert not os.path.exists(manifest_path)
+            for path in missing:
+                with open(path, 'w') as file:
+                    file.write('')
+
+        result = runner.invoke(args=['assets', 'manifest'])
+        assert result.exit_code == 0
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+        assert manifest == assets.build_manifest(app.static_folder)
+
+        manifest['main.css'] = 'main.0123456789ab.css'
+        with open(manifest_path, 'w') as file:
+            json.dump(manifest, file)
+        assets.load_manifest()
+        with app.test_request_context():
+            assert assets.asset_url('main.css') == '/static/main.0123456789ab.css'
+    finally:
+        for path in missing + [manifest_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        assets.load_manifest()
+
+def test_markdown_cache(client, admin, modifies_db):
+    import pages
+    # Converted when the app was created
+    before_form = pages.main.search_markdown()['before_form']
+    hits = render.markdown_html.cache_info().hits
+    assert 'Welcome to the ChETEC-INFRA' in render.markdown_html(before_form)
+    assert render.markdown_html.cache_info().hits == hits + 1
+
+    response = client.get('/search')
+    assert '<h3>Welcome to the ChETEC-INFRA Stable Isotope Database</h3>' in response.text
+
+    # Markdown that changes is still converted
+    client.get('/admin/signup_link/update')
+    signup_key = database.Attrs.get('signup_key')
+    assert f'signup_key={signup_key}' in client.get('/admin/signup_link').text
+    client.get('/admin/signup_link/update')
+    assert database.Attrs.get('signup_key') != signup_key
+    assert f'signup_key={database.Attrs.get("signup_key")}' in client.get('/admin/signup_link').text
+
+def asgi_request(asgi_app, method, path, query_string=b'', body=b'', headers=()):
+    messages = []
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+    async def send(message):
+        messages.append(message)
+
+    scope = dict(type='http', method=method, path=path, query_string=query_string, root_path='',
+                 headers=[(k.lower().encode(), v.encode()) for k, v in headers], scheme='http',
+                 http_version='1.1', server=('localhost', 80), client=('127.0.0.1', 5000))
+    asyncio.run(asgi_app(scope, receive, send))
+
+    assert messages[0]['type'] == 'http.response.start' and messages[-1]['more_body'] is False
+    return (messages[0]['status'], {k.decode(): v.decode() for k, v in messages[0]['headers']},
+            b''.join(m['body'] for m in messages[1:]))
+
+def test_asgi(client, app):
+    asgi_app = asgi.ASGIApp(app, read_paths=app.config['ASGI_READ_PATHS'])
+    assert asgi_app.is_read(dict(method='GET', path='/export'))
+    assert not asgi_app.is_read(dict(method='POST', path='/search'))
+    assert not asgi_app.is_read(dict(method='GET', path='/dm/add_citation'))
+    for path in ['/', '/citations/data', '/dm/complete/journal', '/static/typeahead.js']:
+        assert asgi_app.is_read(dict(method='GET', path=path))
+    # Only the paths ending with * are prefixes
+    for path in ['/admin/signup_link/update', '/user/logout', '/search/missing']:
+        assert not asgi_app.is_read(dict(method='GET', path=path))
+
+    status, headers, body = asgi_request(asgi_app, 'GET', '/search', b'sample_type=CAI')
+    assert status == 200 and headers['content-type'].startswith('text/html')
+    assert body.decode() == client.get('/search', query_string=dict(sample_type='CAI')).text
+
+    # Streamed responses
+    status, headers, body = asgi_request(asgi_app, 'GET', '/export', b'format=csv')
+    assert status == 200
+    assert body.decode() == client.get('/export', query_string=dict(format='csv')).text
+
+    # Write paths
+    status, headers, body = asgi_request(asgi_app, 'POST', '/search', body=b'sample_type=CAI', headers=[
+        ('Content-Type', 'application/x-www-form-urlencoded')])
+    assert status == 200 and len(table_rows(body.decode())) == len(table_rows(
+        client.post('/search', data=dict(sample_type='CAI')).text))
+    status, headers, body = asgi_request(asgi_app, 'GET', '/missing')
+    assert status == 404
+
+def test_search_snapshot(client, moderator, modifies_db, tmp_path):
+    path = str(tmp_path / 'search.snapshot')
+    search_snapshot = snapshot.SearchSnapshot(path)
+    assert search_snapshot.search(sample_type=['CAI'], year=2000) is None
+
+    database.search_backend = search_snapshot
+    try:
+        search_index_equivalent()
+        assert search_snapshot.generation == database.generation(data=True)
+        assert search_snapshot.search(element=['Xx']) == []
+
+        # Another worker uses the same file
+        other = snapshot.SearchSnapshot(path)
+        mtime = os.stat(path).st_mtime_ns
+        assert other.search(sample_type=['CAI']) == search_snapshot.search(sample_type=['CAI'])
+        assert os.stat(path).st_mtime_ns == mtime
+
+        # Only rebuilt after writes of the data
+        database.Attrs.increment('generation')
+        database.commit()
+        search_index_equivalent()
+        assert os.stat(path).st_mtime_ns == mtime
+
+        # Rebuilt after writes of the data
+        citation_id, data_ids = dm_add(client, True)
+        search_index_equivalent()
+        assert os.stat(path).st_mtime_ns != mtime
+
+        dm_remove(client, True, citation_id, data_ids[0])
+        search_index_equivalent()
+        assert other.search(sample_type=['CAI']) == search_snapshot.search(sample_type=['CAI'])
+    finally:
+        database.search_backend = database.search_index
+
+    if snapshot.numpy is None:
+        client.application.config['SEARCH_BACKEND'] = 'snapshot'
+        try:
+            with pytest.raises(RuntimeError):
+                snapshot.init(client.application)
+            assert database.search_backend is database.search_index
+        finally:
+            client.application.config['SEARCH_BACKEND'] = 'index'
+            snapshot.init(client.application)
+
+def test_backup(client, admin, modifies_db, tmp_path):
+    directory = str(tmp_path)
+    ncitations = len(database.Citation.get_all())
+
+    path = backup.backup(directory, compress=False)
+    backup.verify(path)
+    compressed = backup.backup(directory)
+    assert compressed.endswith('.db.gz')
+    backup.verify(compressed)
+    assert [p for p, created in backup.list_backups(directory)] == [compressed, path]
+
+    with open(tmp_path / 'backup-20000101-000000.db', 'wb') as file:
+        file.write(b'Not a database' * 100)
+    with pytest.raises(ValueError):
+        backup.verify(str(tmp_path / 'backup-20000101-000000.db'))
+
+    # Restore
+    database.Citation.delete(1, 1)
+    assert len(database.Citation.get_all()) == ncitations - 1
+    generation = database.generation()
+
+    app = client.application
+    app.config['BACKUP_DIR'] = directory
+    try:
+        safety_copy = backup.restore(compressed)
+        assert len(database.Citation.get_all()) == ncitations
+        assert database.generation() > generation
+        backup.verify(safety_copy)
+        search_index_equivalent()
+
+        # Admin page
+        response = client.get('/admin/backups')
+        assert response.status_code == 200
+        assert os.path.basename(safety_copy) in response.text
+        response = client.post('/admin/backups', follow_redirects=True)
+        assert response.status_code == 200
+        assert len(backup.list_backups(directory)) == 5
+    finally:
+        app.config['BACKUP_DIR'] = config.backupdir
+
+def test_restore_oldest_backup(client, admin, modifies_db, tmp_path):
+    directory = str(tmp_path)
+    newest = backup.backup(directory)
+    newest_created = backup.list_backups(directory)[0][1]
+    for seconds in range(1, config.Config.BACKUP_KEEP_LAST):
+        created = newest_created - datetime.timedelta(seconds=seconds)
+        shutil.copy(newest, tmp_path / f'backup-{created:%Y%m%d-%H%M%S}.db.gz')
+    backups = [path for path, created in backup.list_backups(directory)]
+    assert len(backups) == config.Config.BACKUP_KEEP_LAST
+
+    # Only kept because of keep_last, the safety copy would push it out
+    oldest = backups[-1]
+    app = client.application
+    app.config['BACKUP_DIR'] = directory
+    try:
+        safety_copy = backup.restore(oldest)
+    finally:
+        app.config['BACKUP_DIR'] = config.backupdir
+    assert os.path.exists(oldest)
+    assert [path for path, created in backup.list_backups(directory)] == [safety_copy] + backups
+
+    # It is removed by the next rotation
+    assert backup.rotate(directory) == [oldest]
+
+def test_backup_rotate(tmp_path):
+    start = datetime.datetime(2024, 1, 1)
+    for hours in range(0, 60 * 24, 6):  # Every 6 hours for 60 days
+        created = start + datetime.timedelta(hours=hours)
+        (tmp_path / f'backup-{created:%Y%m%d-%H%M%S}.db.gz').write_bytes(b'')
+
+    removed = backup.rotate(str(tmp_path), keep_last=4, keep_daily=7, keep_weekly=4)
+    kept = [created for path, created in backup.list_backups(str(tmp_path))]
+    assert len(kept) + len(removed) == 240
+    assert kept[:4] == [datetime.datetime(2024, 2, 29, 18) - datetime.timedelta(hours=6 * i) for i in range(4)]
+    # The newest of each of the last 7 days and of each of the last 4 weeks, the last two overlap the days
+    assert ({created.date() for created in kept} ==
+            {datetime.date(2024, 2, day) for day in [11, 18, 23, 24, 25, 26, 27, 28, 29]})
+    assert kept[-1] == datetime.datetime(2024, 2, 11, 18)
+
+def test_citation_search(client, admin, modifies_db):
+    def authors_containing(name, citations):
+        return {citation.id for citation in citations if name in citation.authors}
+
+    # Prefix matching, every word must match
+    total, citations = database.Citation.search_text('schon', limit=100)
+    assert total == len(citations) == 10
+    assert {citation.id for citation in citations} == authors_containing('Schonbachler', database.Citation.get_all())
+    assert database.Citation.search_text('schonbachler nature')[0] == 1
+    assert database.Citation.search_text('schonbachler "')[0] == 10
+    assert database.Citation.search_text('nosuchauthor')[0] == 0
+    assert database.Citation.search_text('')[0] == len(database.Citation.get_all())
+
+    # The index follows edits and matches in the authors rank above those in the journal
+    before = database.Citation.search_text('Shollenberger nature')[0]
+    database.Citation.update_entry(1, 2, journal='Nature Astronomy Letters')
+    total, citations = database.Citation.search_text('Shollenberger nature')
+    assert total == before + 1 and 2 in {citation.id for citation in citations}
+    citation = database.Citation.new_entry(1, creator_id=1, authors='Nature, A', year=2021, journal='Icarus',
+                                           doi='10.1/x', ads='')
+    total, citations = database.Citation.search_text('nature')
+    assert citations[0].id == citation.id
+
+    # Paging
+    total, page1 = database.Citation.search_text('nature', limit=2)
+    total, page2 = database.Citation.search_text('nature', limit=2, offset=2)
+    assert len(page1) == 2 and not {c.id for c in page1} & {c.id for c in page2}
+
+    # Combined with the data filters
+    total, citations = database.Citation.search_text('schon', limit=100, sample_type=['CAI'])
+    cai = database.Citation.get_all(id=database.search_index.search(sample_type=['CAI']))
+    assert 0 < total < 10
+    assert {citation.id for citation in citations} == authors_containing('Schonbachler', cai)
+
+    # And deletes
+    database.Citation.update_entry(1, citation.id, authors='Renamed, Q')
+    assert database.Citation.search_text('nature icarus')[0] == 0
+    assert database.Citation.search_text('renamed')[0] == 1
+    database.Citation.delete(1, citation.id)
+    assert database.Citation.search_text('renamed')[0] == 0
+
+    # Pages
+    database.flask.g.pop('_login_user', None)
+    response = client.get('/citations', query_string=dict(q='schon'))
+    assert response.status_code == 200
+    assert '/citations/data?q=schon' in response.text
+    response = client.get('/citations/data', query_string=dict(q='schon', limit=4, sort=1, order='desc'))
+    assert response.json['total'] == 10
+    years = [row[1] for row in response.json['results']]
+    assert len(years) == 4 and years == sorted(years, reverse=True)
+    assert client.get('/citations/data', query_string=dict(q='schon', limit=4, sort=1, order='desc'),
+                      headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+def test_citation_listing(client, verified, modifies_db):
+    citations = database.Citation.get_all()
+    expected = [(c.id, database.Citation.label(c.year, c.authors, c.journal, c.doi))
+                for c in sorted(citations, key=lambda c: (c.year, c.authors, c.journal, c.id))]
+    assert database.Citation.get_citations() == expected
+    assert database.Citation.get_citations(limit=5, offset=3) == expected[3:8]
+    assert all('Schonbachler' in database.Citation.get_one(id=id).authors
+               for id, label in database.Citation.get_citations(search='schon'))
+
+    # The typeahead only shows the citations of the user unless they are a moderator
+    verified_id = database.User.get_one(name='verified').id
+    own = database.Citation.new_entry(verified_id, creator_id=verified_id, authors='Typeahead, T', year=2022,
+                                      journal='Icarus', doi='10.1/typeahead', ads='')
+    response = client.get('/dm/citations', query_string=dict(q='typea'))
+    assert response.json['results'] == [dict(id=own.id, label=database.Citation.get_citations(id=own.id)[0][1])]
+    response = client.get('/dm/citations')
+    assert [result['id'] for result in response.json['results']] == [own.id]
+
+    # The add data form only has the selected citation as a choice
+    response = client.get('/dm/add_data')
+    assert 'data-typeahead="/dm/citations"' in response.text
+    assert '<option' not in response.text.split('id="citation"', 1)[1].split('</select>', 1)[0]
+    response = client.post('/dm/add_data', data=dict(citation=own.id, sample_type='CAI', element='Mo'),
+                           follow_redirects=True)
+    assert 'Data added' in response.text
+    assert database.Data.get_all('element', citation_id=own.id) == ['Mo']
+    response = client.post('/dm/add_data', data=dict(citation=1, sample_type='CAI', element='Mo'),
+                           follow_redirects=True)
+    assert 'Data added' not in response.text
+
+def test_autocomplete(client, verified, modifies_db):
+    assert database.Citation.complete('journal', 'nat') == ['Nature', 'Nature Astronomy']
+    assert database.Citation.complete('journal', 'NAT', limit=1) == ['Nature']
+    assert database.Citation.complete('journal', 'xyz') == []
+    assert database.Citation.find_value('journal', 'nature astronomy') == 'Nature Astronomy'
+    assert database.Citation.find_value('journal', 'Nature Astro') is None
+    assert database.Data.complete('sample_type', 'w') == ['Wholerock', 'WR-Leachate']
+
+    # New values show up immediately and are removed with the last row using them
+    verified_id = database.User.get_one(name='verified').id
+    citation = database.Citation.new_entry(verified_id, creator_id=verified_id, authors='Complete, C', year=2022,
+                                           journal='Natural Sciences', doi='10.1/complete', ads='')
+    assert database.Citation.complete('journal', 'natu') == ['Natural Sciences', 'Nature', 'Nature Astronomy']
+    database.Citation.update_entry(verified_id, citation.id, journal='Icarus')
+    assert database.Citation.complete('journal', 'natu') == ['Nature', 'Nature Astronomy']
+    assert database.Citation.find_value('journal', 'ICARUS') == 'Icarus'
+    database.Citation.delete(verified_id, citation.id)
+    assert database.Citation.find_value('journal', 'icarus') is None
+    assert database.Citation.find_value('journal', 'nature') == 'Nature'
+
+    response = client.get('/dm/complete/sample_type', query_string=dict(q='c'))
+    assert response.json == dict(results=[dict(id='CAI', label='CAI'), dict(id='Chondrules', label='Chondrules')])
+    assert client.get('/dm/complete/authors').status_code == 404
+
+    # The forms only hold the new entry choice and check the entries with the index
+    response = client.get('/dm/add_citation')
+    assert 'Geochimica et Cosmochimica Acta' not in response.text
+    assert 'data-typeahead="/dm/complete/journal"' in response.text
+
+    data = dict(authors='Form, F', year=2022, journal='<New Journal>', journal_new='nature astronomy',
+                doi='10.1/form', ads='')
+    response = client.post('/dm/add_citation', data=data, follow_redirects=True)
+    assert 'The new entry already exits in this list' in response.text
+    response = client.post('/dm/add_citation', data=dict(data, journal='Nature Astronomy', journal_new=''),
+                           follow_redirects=True)
+    assert 'Citation added' in response.text
+    response = client.post('/dm/add_citation', data=dict(data, doi='10.1/form2', journal='Not A Journal',
+                                                         journal_new=''), follow_redirects=True)
+    assert 'Citation added' not in response.text
+
+def write_from_other_process(sql, *params):
+    # Writes like another worker process would, through its own connection, and moves the generations on
+    connection = sqlite3.connect(config.test_db_path, timeout=10)
+    try:
+        with connection:
+            connection.execute(sql, params)
+            for key in ('generation', 'data_generation'):
+                connection.execute("INSERT INTO attrs (key, value) VALUES (?, '1') ON CONFLICT (key) "
+                                   "DO UPDATE SET value = CAST(CAST(value AS INTEGER) + 1 AS TEXT)", (key,))
+    finally:
+        connection.close()
+    # The fixtures of the users keep a request context for the whole test, the next request would read them again
+    database.flask.g.pop('_generations', None)
+
+def test_search_index_other_process(client, modifies_db):
+    search_index_equivalent()
+    without_mo = [citation.id for citation in database.Citation.get_all()
+                  if 'Mo' not in database.Data.get_all('element', citation_id=citation.id)]
+    write_from_other_process('INSERT INTO data (citation_id, creator_id, sample_type, element) VALUES (?, 1, ?, ?)',
+                             without_mo[0], 'CAI', 'Mo')
+    search_index_equivalent()
+    assert without_mo[0] in database.search_index.search(element=['Mo'])
+
+    write_from_other_process('DELETE FROM data WHERE citation_id = ? AND element = ?', without_mo[0], 'Mo')
+    search_index_equivalent()
+    assert without_mo[0] not in database.search_index.search(element=['Mo'])
+
+    # Writes made by this process are applied to the index, which stays at the generation of the database
+    bitmaps = database.search_index.bitmaps
+    database.Data.new_entry(1, creator_id=1, citation_id=without_mo[0], sample_type='CAI', element='Mo')
+    assert database.search_index.generation == database.generation(data=True)
+    search_index_equivalent()
+    assert database.search_index.bitmaps is bitmaps
+
+def test_facets_other_process(client, modifies_db):
+    assert 'Hibonite' not in database.Data.get_facet('sample_type')
+    write_from_other_process('INSERT INTO data (citation_id, creator_id, sample_type, element) VALUES (1, 1, ?, ?)',
+                             'Hibonite', 'Ca')
+    assert database.Data.get_facet('sample_type', counts=True)['Hibonite'] == 1
+
+    # The new sample type can be searched for
+    database.flask.g.pop('_login_user', None)
+    response = client.get('/search', query_string=dict(sample_type='Hibonite'))
+    assert len(table_rows(response.text)) == 1
+
+def test_autocomplete_other_process(client, verified, modifies_db):
+    assert database.Citation.complete('journal', 'ica') == []
+    write_from_other_process("INSERT INTO citation (creator_id, authors, year, journal, doi, ads) "
+                             "VALUES (1, 'Other, O', 2022, 'Icarus', '10.1/other', '')")
+    assert database.Citation.complete('journal', 'ica') == ['Icarus']
+    assert database.Citation.find_value('journal', 'ICARUS') == 'Icarus'
+
+    # Entries written after the index was checked are found in the database
+    connection = sqlite3.connect(config.test_db_path)
+    with connection:
+        connection.execute("UPDATE citation SET journal = 'Planetary Science Journal' WHERE doi = '10.1/other'")
+    connection.close()
+    assert database.Citation.find_value('journal', 'planetary science journal') == 'Planetary Science Journal'
+
+    data = dict(authors='Form, F', year=2022, journal='<New Journal>', journal_new='PLANETARY Science Journal',
+                doi='10.1/form', ads='')
+    response = client.post('/dm/add_citation', data=data, follow_redirects=True)
+    assert 'The new entry already exits in this list' in response.text
+    response = client.post('/dm/add_citation', data=dict(data, journal='Planetary Science Journal', journal_new=''),
+                           follow_redirects=True)
+    assert 'Citation added' in response.text
+
+def test_import_batched(client, modifies_db):
+    search_index_equivalent()
+    database.Citation.complete('journal', '')
+    rows = [(i, dict(authors=f'Batch{i}, B', year='2020', journal='NATURE astronomy' if i % 2 else 'Batch Journal',
+                     doi=f'10.1234/batch{i}', ads='', sample_type='cai' if i % 2 else 'Batch Grain',
+                     element='Mo, Pd, Ru'))
+            for i in range(100)]
+
+    statements = []
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    sqlalchemy.event.listen(database.db.engine, 'before_cursor_execute', count)
+    try:
+        result = importer.import_rows(1, rows)
+    finally:
+        sqlalchemy.event.remove(database.db.engine, 'before_cursor_execute', count)
+
+    assert result.citations == 100 and result.data == 300
+    assert len(statements) < 20
+    assert sum('INTO attrs' in statement for statement in statements) == 2  # generation and data_generation
+
+    # Existing spellings are used and the caches were updated in place
+    assert database.Citation.get_facet('journal', counts=True)['Nature Astronomy'] > 50
+    assert 'NATURE astronomy' not in database.Citation.get_facet('journal')
+    assert database.Data.get_facet('sample_type', counts=True)['CAI'] > 150
+    assert database.Citation.complete('journal', 'batch') == ['Batch Journal']
+    assert database.search_index.generation == database.generation(data=True)
+    search_index_equivalent()
+    assert [d.citation_id for d in database.Data.get_all(element='Ru', sample_type='Batch Grain')] == \
+           [database.Citation.get_one(doi=f'10.1234/batch{i}').id for i in range(0, 100, 2)]
+
+def test_migration_rollback(app):
+    version = migrations.get_version()
+
+    @migrations.migration(version + 1, 'Fails')
+    def fails(connection):
+        connection.exec_driver_sql('CREATE INDEX ix_data_element_citation_id ON data (element, citation_id)')
+        connection.exec_driver_sql('DELETE FROM data')
+        raise RuntimeError('Failed')
+
+    try:
+        with database.db.engine.begin() as connection:
+            connection.exec_driver_sql(f'PRAGMA user_version = {version - 1}')
+            connection.exec_driver_sql('DROP INDEX ix_citation_year_authors_journal_doi')
+        count = database.db.session.execute(sqlalchemy.text('SELECT count(*) FROM data')).scalar()
+
+        with pytest.raises(RuntimeError):
+            migrations.upgrade()
+
+        # Neither the migrations before the failing one nor its statements are kept
+        assert migrations.get_version() == version - 1
+        with database.db.engine.connect() as connection:
+            indexes = [row[1] for row in connection.exec_driver_sql('PRAGMA index_list(data)')]
+            assert 'ix_data_element_citation_id' not in indexes
+            indexes = [row[1] for row in connection.exec_driver_sql('PRAGMA index_list(citation)')]
+            assert 'ix_citation_year_authors_journal_doi' not in indexes
+            assert connection.exec_driver_sql('SELECT count(*) FROM data').scalar() == count
+    finally:
+        migrations.MIGRATIONS[:] = [m for m in migrations.MIGRATIONS if m[2] is not fails]
+
+    assert migrations.upgrade() == [migrations.MIGRATIONS[-1][:2]]
+    assert migrations.get_version() == version